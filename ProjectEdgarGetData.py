@@ -1,242 +1,443 @@
-from edgar import Company, set_identity
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
-from tqdm import tqdm
-import yfinance as yf
+import threading
+import json
 import time
 import os
 
+from fetch_utils import EDGARTOOLS_REQUESTS, SEC_LIMITER, run_per_ticker, with_retries
+from bulk_ingest import read_facts
+from facts_engine import FACTS_COLUMNS, extract_concepts
+from metrics import METRICS, serve_from_env
+from response_cache import MISSING_TTL, PRICES_TTL, SUBMISSIONS_TTL, get_cache
+from storage import get_corpus, write_table
+
 #  https://pypi.org/project/edgartools/3.0.1/
 
-def adjust_to_next_business_day(date_str):
+# Company tickers of the constituents of the DJIA since 2009 including adds/drops
+DJIA_TICKERS = ["AAPL", "AMGN", "AMZN", "AXP", "BA", "CAT", "CRM", "CSCO", "CVX", "DIS",
+                "GS", "HD", "HON", "IBM", "JNJ", "JPM", "KO", "MCD", "MMM", "MRK",
+                "MSFT", "NKE", "PG", "TRV", "UNH", "V", "VZ", "WMT", "SHW", "NVDA",
+                "INTC", "DOW", "GE", "T", "HPQ", "BAC", "AA", "XOM", "PFE", "RTX"]
+
+def get_ticker_assets(ticker: str, start_year: int, concepts=("Assets",)):
     '''
-    Adjust a given date string to the next business day if it falls on a weekend or non-trading day.
-    :param date_str: A date string in the format 'YYYY-MM-DD'
-    :return: A string representing the next business day
+    Retrieves the asset values for a single ticker from SEC EDGAR.  The company facts are fetched once and kept as
+    Parquet so every concept is pulled from the same local copy, and the time and memory it took are printed so the
+    cost of scaling to more tickers can be judged.
+    :param ticker: string stock ticker identifier
+    :param start_year: year to begin grabbing filings
+    :param concepts: XBRL concepts to extract, defaults to the 'Assets' fact
+    :return: data frame of the ticker's assets and the sorted list of related filing dates
     '''
-    # Convert the string to a pandas Timestamp
-    date = pd.Timestamp(date_str)
+    filtered_df, stats = extract_concepts(ticker, concepts=concepts, start_year=start_year)
 
-    # If it's already a business day, return as is
-    if date.weekday() < 5:  # Monday to Friday are 0-4
-        return date.strftime('%Y-%m-%d')
+    peak = f"{stats['process_peak_rss_mb']:.0f} MB" if stats["process_peak_rss_mb"] is not None else "n/a"
+    print(f"{ticker}: {stats['rows']} of {stats['facts_rows']} facts rows, {stats['arrow_mb']:.1f} MB read, "
+          f"load {stats['load_s']:.2f}s, extract {stats['extract_s']:.2f}s, {stats['ticker_mb']:.1f} MB held, "
+          f"process peak RSS {peak}")
 
-    # If it's a weekend, adjust to the next business day
-    next_business_day = pd.bdate_range(start=date, periods=1)[0]
-    return next_business_day.strftime('%Y-%m-%d')
+    return filtered_df, sorted(set(filtered_df['filed'].dt.strftime('%Y-%m-%d')))
 
-def get_assets(tickers: list, start_year: int):
+def _combine_assets(results: dict):
+    '''
+    Combine per-ticker asset results into one data frame and save it as a Parquet file locally.
+    :param results: dictionary of ticker to (data frame, filing dates) as returned by get_ticker_assets
+    :return: data frame of assets and a dictionary of related filing dates for each ticker
+    '''
+    # Combine all individual DataFrames into one, an empty frame with the same columns when every ticker failed
+    frames = [df for df, _ in results.values()]
+    final_df = pd.concat(frames) if frames else pd.DataFrame(columns=FACTS_COLUMNS + ["Ticker"])
+
+    # Save the final DataFrame to a Parquet file
+    write_table(final_df, "assets_data.parquet")
+
+    return final_df, {ticker: dates for ticker, (_, dates) in results.items()}
+
+def get_assets(tickers: list, start_year: int, max_workers=4, concepts=("Assets",), facts_table=None):
     '''
     This function takes a list of ticker symbols and retrieves the asset values for the given timeframe from SEC EDGAR
-    database using the edgartools module.  It saves as a csv file locally and returns the data frame and a dictionary
+    database using the edgartools module.  It saves as a Parquet file locally and returns the data frame and a dictionary
     of related filing dates.
     :param tickers: list of strings of stock ticker identifiers
     :param start_year: year to begin grabbing filings
+    :param max_workers: number of tickers fetched concurrently
+    :param concepts: XBRL concepts to extract, defaults to the 'Assets' fact
+    :param facts_table: folder of a facts table built by bulk_ingest from companyfacts.zip, when given every ticker is
+    answered from it in one pass without any network
     :return: data frame of assets with dates organized including tickers as well as a dictionary of related filing dates
     for each ticker
     '''
-    # Initialize an empty dictionary to store dates by ticker
-    ticker_filed_dates = {}
-
-    # Initialize an empty list to store DataFrames
-    all_data = []
+    if facts_table is not None:
+        final_df = read_facts(tickers, concepts=concepts, start_year=start_year, facts_table=facts_table)
+        return _combine_assets({ticker: (group, sorted(set(group['filed'].dt.strftime('%Y-%m-%d'))))
+                                for ticker, group in final_df.groupby("Ticker", sort=False)})
 
-    # Loop through each ticker
-    for ticker in tqdm(tickers, desc="Grabbing each ticker's assets..."):
-        try:
-            # Initialize the Company instance
-            company = Company(ticker)
-
-            # Retrieve all 10-Q and 10-K filings since start_year
-            filings_q = company.get_filings(form="10-Q").filter(date=f"{start_year}-01-01:")
-            filings_k = company.get_filings(form="10-K").filter(date=f"{start_year}-01-01:")
-
-            # Convert filings to a DataFrame and filter for 'Assets' fact
-            df_q = company.get_facts().to_pandas()
-            df_k = company.get_facts().to_pandas()
-            df_q = df_q[df_q['filed'] >= f"{start_year}-01-01"].copy()
-            df_k = df_k[df_k['filed'] >= f"{start_year}-01-01"].copy()
-            df_q = df_q.query("fact == 'Assets' and form == '10-Q'").copy()
-            df_k = df_k.query("fact == 'Assets' and form == '10-K'").copy()
-
-            # Combine 10-Q and 10-K DataFrames
-            combined_df = pd.concat([df_q, df_k])
-
-            # Ensure 'filed' and 'end' columns are datetime
-            combined_df['filed'] = pd.to_datetime(combined_df['filed']).copy()
-            combined_df['end'] = pd.to_datetime(combined_df['end']).copy()
+    results = run_per_ticker(tickers, lambda ticker: get_ticker_assets(ticker, start_year, concepts),
+                             max_workers=max_workers, desc="Assets")
 
-            # Sort by end date and then by filed date
-            combined_df = combined_df.sort_values(by=['end', 'filed']).copy()
+    return _combine_assets(results)
 
-            # Deduplicate to keep only the first instance per end date
-            filtered_df = combined_df.drop_duplicates(subset='end', keep='first').copy()
+def download_prices(tickers: list, start: str, end: str, prices_file=None):
+    '''
+    Gets the daily adjusted close prices of all tickers from yahoo finance in a single multi-ticker request, served
+    from the response cache when the same request was made recently.  A local price file can be given instead to work
+    without the network.
+    :param tickers: list of strings of stock ticker identifiers
+    :param start: first date to download as 'YYYY-MM-DD'
+    :param end: date to stop before as 'YYYY-MM-DD'
+    :param prices_file: optional Parquet or csv file with Date, Ticker and Adj Close columns
+    :return: long data frame with Date, Ticker and Adj Close columns
+    '''
+    if prices_file is not None:
+        prices = pd.read_parquet(prices_file) if prices_file.endswith(".parquet") else pd.read_csv(prices_file)
+        prices['Date'] = pd.to_datetime(prices['Date'])
+        return prices[prices['Ticker'].isin(tickers)][['Date', 'Ticker', 'Adj Close']]
 
-            # Add the ticker symbol to the DataFrame
-            filtered_df.loc[:,"Ticker"] = ticker
+    def fetch():
+        # Imported on first download, yfinance is slow to import and cached prices do not need it
+        import yfinance as yf
 
-            # Append the filtered data to the all_data list
-            all_data.append(filtered_df)
+        with METRICS.timer("http_request_seconds", endpoint="yahoo"):
+            return with_retries(yf.download, list(tickers), start=start, end=end, group_by="ticker",
+                                auto_adjust=False, progress=False)
 
-            # Store unique filed dates for this ticker
-            ticker_filed_dates[ticker] = sorted(set(filtered_df['filed'].dt.strftime('%Y-%m-%d')))
+    data = get_cache().cached(f"prices:{','.join(sorted(tickers))}:{start}:{end}", fetch, ttl=PRICES_TTL)
 
-        except Exception as e:
-            print(f"An error occurred for ticker {ticker}: {e}")
+    # Yahoo returns an empty frame without any fields for unknown tickers or a range without trading days
+    if data.empty or "Adj Close" not in data.columns.get_level_values(-1):
+        return pd.DataFrame({'Date': pd.Series(dtype='datetime64[ns]'), 'Ticker': pd.Series(dtype='object'),
+                             'Adj Close': pd.Series(dtype='float64')})
 
-    # Combine all individual DataFrames into one
-    final_df = pd.concat(all_data)
+    # Put the tickers in the columns if yahoo returned a single ticker without them
+    if not isinstance(data.columns, pd.MultiIndex):
+        data.columns = pd.MultiIndex.from_product([tickers, data.columns])
 
-    # Save the final DataFrame to a CSV file
-    final_df.to_csv("assets_data.csv")
+    # Reshape the wide Date x (Ticker, field) frame into one row per ticker and date
+    adj_close = data.xs("Adj Close", axis=1, level=1)
+    adj_close.columns.name = "Ticker"
+    adj_close.index.name = "Date"
+    prices = adj_close.stack().dropna().rename("Adj Close").reset_index()
+    prices['Date'] = pd.to_datetime(prices['Date']).dt.tz_localize(None)
 
-    return final_df, ticker_filed_dates
+    return prices
 
-def get_prices(ticker_filed_dates: dict):
+def get_prices(ticker_filed_dates: dict, prices_file=None):
     '''
     This function gets the prices from yahoo finance using yfinance module for comparative purposes to the assets from
-    SEC EDGAR database.  It saves as a csv file locally and returns the data frame.
+    SEC EDGAR database.  All tickers are downloaded at once and every filing date is matched to the first trading day
+    on or after it with merge_asof, which takes care of weekends as well as market holidays.  It saves as a Parquet file
+    locally and returns the data frame.
     :param ticker_filed_dates: dictionary of related stock tickers and 10-Q filing dates
+    :param prices_file: optional local price file used instead of downloading, see download_prices
     :return: data frame of prices and period returns with dates organized including tickers
     '''
+    # One row per ticker and filing date
+    filings = pd.DataFrame(
+        [(ticker, date) for ticker, dates in ticker_filed_dates.items() for date in dates],
+        columns=['Ticker', 'Filed']
+    )
+    filings['Filed'] = pd.to_datetime(filings['Filed'])
+
+    # Every assets ticker failed or the date filter left no filings, there is nothing to price
+    if filings.empty:
+        print("No filing dates to get prices for")
+        return pd.DataFrame({'Ticker': pd.Series(dtype='object'), 'Date': pd.Series(dtype='object'),
+                             'Adj Close': pd.Series(dtype='float64'),
+                             'Interperiod Return Pct': pd.Series(dtype='float64')})
+
+    # Download a week past the last filing so filings just before a long weekend still find a trading day
+    start = filings['Filed'].min().strftime('%Y-%m-%d')
+    end = (filings['Filed'].max() + pd.Timedelta(days=7)).strftime('%Y-%m-%d')
+    prices = download_prices(list(ticker_filed_dates), start, end, prices_file=prices_file)
+
+    # Match each filing to the next trading day the ticker has a price for
+    aligned = pd.merge_asof(
+        filings.sort_values('Filed'),
+        prices.sort_values('Date'),
+        left_on='Filed',
+        right_on='Date',
+        by='Ticker',
+        direction='forward',
+        tolerance=pd.Timedelta(days=7),
+    )
 
-    # Initialize an empty list to store DataFrame rows
-    data_rows = []
+    # Two filings landing on the same trading day only need the price once
+    extended_df = (aligned.dropna(subset=['Date'])
+                   .drop_duplicates(subset=['Ticker', 'Date'])
+                   .sort_values(['Ticker', 'Date'])
+                   .reset_index(drop=True)[['Ticker', 'Date', 'Adj Close']])
+    extended_df['Date'] = extended_df['Date'].dt.strftime('%Y-%m-%d')
 
-    # Loop through each ticker and its associated filed dates
-    for ticker, dates in tqdm(ticker_filed_dates.items(), desc="Grabbing each ticker's prices..."):
-        try:
-            # Adjust all dates to the next business day
-            adjusted_dates = [adjust_to_next_business_day(date) for date in dates]
+    # Calculate interperiod returns grouped by ticker
+    extended_df['Interperiod Return Pct'] = (
+        extended_df.groupby('Ticker')['Adj Close']
+        .pct_change()  # Compute percentage change
+    )
 
-            # Determine the min and max dates for this ticker
-            min_date = min(adjusted_dates)
-            max_date = (pd.Timestamp(max(adjusted_dates)) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')  # Extend by 1 day
+    # Save the final DataFrame to a Parquet file
+    write_table(extended_df, "final_prices.parquet")
 
-            # Fetch data for the date range of this ticker
-            data = yf.download(ticker, start=min_date, end=max_date, group_by="ticker", progress=False)
+    # Display the first few rows of the final DataFrame
+    print(extended_df.head())
 
-            # Check if data is not empty
-            if not data.empty:
-                # Drop the 'Ticker' level in the MultiIndex if present
-                if isinstance(data.columns, pd.MultiIndex):
-                    data.columns = data.columns.droplevel(0)
+    return extended_df
 
-                # Convert data index to date-only strings
-                data.index = data.index.strftime('%Y-%m-%d')
+def _extract_mda(filings, accession_no: str):
+    '''
+    Parse a single 10-Q and pull out Item 2.
+    :param filings: edgartools filings of the company
+    :param accession_no: accession number of the filing to parse
+    :return: the MD&A text or None if Item 2 could not be located
+    '''
+    filing = next(filing for filing in filings if filing.accession_no == accession_no)
 
-                # Filter the data to include only the adjusted filed dates for this ticker
-                filtered_data = data[data.index.isin(adjusted_dates)]
+    # Get the filing object, edgartools downloads and parses the document here
+    with METRICS.timer("edgar_fetch_seconds", call="10q"):
+        tenq = with_retries(filing.obj, limiter=SEC_LIMITER, tokens=EDGARTOOLS_REQUESTS)
 
-                # Extract the adjusted close price for each date in filtered_data
-                for date in filtered_data.index:
-                    adj_close = filtered_data.loc[date, "Adj Close"] if "Adj Close" in filtered_data.columns else None
+    # Extract Item 2 (Management's Discussion and Analysis)
+    with METRICS.timer("parse_seconds", step="item2"):
+        if "Item 2" in tenq.items:
+            return tenq["Item 2"]
+    return None
 
-                    # Append the data row
-                    data_rows.append({
-                        "Ticker": ticker,
-                        "Date": date,
-                        "Adj Close": adj_close
-                    })
+class MdaManifest:
+    '''
+    Records which 10-Q accession numbers have already been extracted into the MD&A corpus, so a sync only has to fetch
+    and parse filings that are new since the last run.  The manifest is kept as manifest.json inside the output folder
+    and is shared between the worker threads of a run.
+    :param output_folder: string folder name the manifest is kept in, older versions also saved a .txt file per filing
+    there
+    :param corpus: MdaCorpus the texts are saved in, the shared default store if not given
+    '''
 
+    def __init__(self, output_folder="mda_texts", corpus=None):
+        self.output_folder = output_folder
+        self.corpus = corpus if corpus is not None else get_corpus()
+        self.path = os.path.join(output_folder, "manifest.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def is_synced(self, accession_no: str):
+        '''
+        A filing is synced when its text is in the corpus, it was found to have an empty MD&A, or Item 2 could not be
+        located in it recently.  Missing filings are tried again after MISSING_TTL in case the filing was fixed.
+        :param accession_no: accession number of the filing
+        :return: True if the filing does not need to be fetched again
+        '''
+        with self._lock:
+            entry = self.entries.get(accession_no)
+        if entry is None:
+            return False
+        if entry["status"] == "missing":
+            return time.time() - entry.get("recorded", 0) < MISSING_TTL
+        if entry["status"] != "saved":
+            return True
+        return accession_no in self.corpus
+
+    def record(self, accession_no: str, ticker: str, filing_date: str, status: str, filename=None):
+        '''
+        Record the outcome of extracting a filing.
+        :param accession_no: accession number of the filing
+        :param ticker: string stock ticker identifier
+        :param filing_date: filing date as 'YYYY-MM-DD'
+        :param status: 'saved', 'empty' or 'missing'
+        :param filename: name of the .txt file older versions saved the text in, None for the corpus
+        '''
+        with self._lock:
+            self.entries[accession_no] = {
+                "ticker": ticker,
+                "filing_date": filing_date,
+                "status": status,
+                "filename": filename,
+                "recorded": time.time(),
+            }
+
+    def save(self):
+        '''
+        Write the manifest atomically so an interrupted run never leaves a half written file behind.
+        '''
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+def get_ticker_mda(ticker: str, start_year: int, output_folder="mda_texts", manifest=None, corpus=None):
+    '''
+    Saves the Management Discussion and Analysis of every 10-Q of a single ticker since start_year in the corpus.  The
+    filing index is cached for a day and the extracted MD&A for good, as a filing does not change once it is accepted,
+    so EDGAR is only contacted when something is not in the cache yet.  A filing whose Item 2 was not found is parsed
+    again after a day.  Filings already recorded in the manifest are skipped.
+    :param ticker: string stock ticker identifier
+    :param start_year: year to begin grabbing filings
+    :param output_folder: string folder name of the manifest
+    :param manifest: MdaManifest shared by the run, one is loaded from output_folder if not given
+    :param corpus: MdaCorpus shared by the run, the shared default store if not given
+    :return: tuple of the number of files saved, skipped and failed
+    '''
+    if corpus is None:
+        corpus = get_corpus()
+    if manifest is None:
+        manifest = MdaManifest(output_folder, corpus)
+
+    saved_count = 0
+    skipped_count = 0
+    failed_count = 0
+    filings = None
+
+    def load_filings():
+        # Only create the company and fetch its filings once something actually needs them
+        nonlocal filings
+        if filings is None:
+            # edgartools takes a second to import, tickers whose filings are all synced never load it
+            from edgar import Company
+
+            with METRICS.timer("edgar_fetch_seconds", call="filings"):
+                company = with_retries(Company, ticker, limiter=SEC_LIMITER, tokens=EDGARTOOLS_REQUESTS)
+                filings = with_retries(lambda: company.get_filings(form="10-Q").filter(date=f"{start_year}-01-01:"),
+                                       limiter=SEC_LIMITER, tokens=EDGARTOOLS_REQUESTS)
+        return filings
+
+    # Fetch the accession number and date of all 10-Q filings since the starting year
+    filing_index = get_cache().cached(f"10q-index:{ticker}:{start_year}",
+                                lambda: [(filing.accession_no, str(filing.filing_date)) for filing in load_filings()],
+                                ttl=SUBMISSIONS_TTL)
+
+    # Loop through each filing
+    for accession_no, filing_date in filing_index:
+        # Move filings older versions saved as .txt files into the corpus instead of fetching them again
+        entry = manifest.entries.get(accession_no)
+        if entry is not None and entry["status"] == "saved" and entry["filename"] and accession_no not in corpus:
+            legacy_path = os.path.join(output_folder, entry["filename"])
+            if os.path.exists(legacy_path):
+                with open(legacy_path, "r", encoding="utf-8") as file:
+                    corpus.append(ticker, filing_date, accession_no, file.read())
+
+        # Nothing to do for filings extracted by an earlier sync
+        if manifest.is_synced(accession_no):
+            skipped_count += 1
+            continue
+
+        try:
+            tenq_mda = get_cache().cached(f"mda:{accession_no}", lambda: _extract_mda(load_filings(), accession_no))
+
+            # Save the MD&A section in the corpus
+            if tenq_mda is None:
+                failed_count += 1
+                manifest.record(accession_no, ticker, filing_date, "missing")
+                print(f"Item 2 not found for {ticker} on {filing_date}")
+            elif tenq_mda:
+                saved_count += 1
+                corpus.append(ticker, filing_date, accession_no, tenq_mda)
+                manifest.record(accession_no, ticker, filing_date, "saved")
+            else:
+                manifest.record(accession_no, ticker, filing_date, "empty")
         except Exception as e:
-            print(f"Error fetching data for {ticker}: {e}")
+            print(f"Error processing filing for {ticker} on {filing_date}: {e}")
 
-    # Convert the list of rows into a DataFrame
-    extended_df = pd.DataFrame(data_rows)
+    # Persist progress after every ticker so an interrupted sync resumes where it stopped
+    corpus.flush()
+    manifest.save()
 
-    # Calculate interperiod returns grouped by ticker
-    extended_df['Interperiod Return Pct'] = (
-        extended_df.groupby('Ticker')['Adj Close']
-        .pct_change()  # Compute percentage change
-    )
+    return saved_count, skipped_count, failed_count
 
-    # Save the final DataFrame to a CSV file
-    extended_df.to_csv("final_prices.csv", index=False)
+def _report_mda(results: dict):
+    '''
+    Print the analytics of a MD&A run.
+    :param results: dictionary of ticker to the (saved, skipped, failed) counts returned by get_ticker_mda
+    '''
+    saved_count = sum(saved for saved, _, _ in results.values())
+    skipped_count = sum(skipped for _, skipped, _ in results.values())
+    failed_count = sum(failed for _, _, failed in results.values())
 
-    # Display the first few rows of the final DataFrame
-    print(extended_df.head())
+    METRICS.inc("mda_filings_total", saved_count, status="saved")
+    METRICS.inc("mda_filings_total", skipped_count, status="skipped")
+    METRICS.inc("mda_filings_total", failed_count, status="failed")
 
-    return extended_df
+    print("Cycle Complete")
+    print(f"Saved {saved_count} MD&A texts")
+    print(f"Skipped {skipped_count} filings already synced")
+    print(f"Failed to save {failed_count} MDA extracts")
+    # An incremental sync with nothing new saves no files at all
+    if saved_count:
+        print(f"Successfully saved {(1 - (failed_count/saved_count))*100:.2f} percentage of documents")
 
-def get_mda_as_txt(company_tickers: list, start_year: int, output_folder="mda_texts"):
+def get_mda_as_txt(company_tickers: list, start_year: int, output_folder="mda_texts", max_workers=4):
     '''
     This function grabs the 10-Q filing object and saves the text from the Management Discussion and Analysis locally
-    as a .txt file
+    in the MD&A corpus, which sentiment, chunking and the vector and keyword indexes read it from
     :param company_tickers: list of strings of stock ticker identifiers
     :param start_year: year to begin grabbing filings
-    :param output_folder: string folder name to save the text files
-    :return: Saves the text files and prints some analytics based on file handling
+    :param output_folder: string folder name of the sync manifest
+    :param max_workers: number of tickers fetched concurrently
+    :return: dictionary of ticker to the (saved, skipped, failed) counts, the texts are saved and some analytics
+    based on file handling are printed
     '''
     # Create output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
 
-    # Keep count of files saved and failed as some filings are not located in correct spot/format
-    saved_count = 0
-    failed_count = 0
+    # Only filings missing from the manifest are fetched and parsed
+    corpus = get_corpus()
+    manifest = MdaManifest(output_folder, corpus)
+    results = run_per_ticker(company_tickers,
+                             lambda ticker: get_ticker_mda(ticker, start_year, output_folder, manifest, corpus),
+                             max_workers=max_workers, desc="MD&A")
 
-    for ticker in tqdm(company_tickers, desc="Grabbing each ticker's MD&A"):
-        try:
-            # Initialize the company
-            company = Company(ticker)
-
-            # Fetch all 10-Q filings since the starting year
-            filings = company.get_filings(form="10-Q").filter(date=f"{start_year}-01-01:")
-
-            # Loop through each filing
-            for filing in filings:
-                try:
-                    # Get the filing object
-                    tenq = filing.obj()
-
-                    # Extract Item 2 (Management's Discussion and Analysis)
-                    if "Item 2" in tenq.items:
-                        tenq_mda = tenq["Item 2"]
-
-                        # Save the MD&A section as a .txt file
-                        if tenq_mda:
-                            saved_count += 1
-                            filename = f"{ticker}_{filing.filing_date}.txt"
-                            filepath = os.path.join(output_folder, filename)
-                            with open(filepath, "w", encoding="utf-8") as file:
-                                file.write(tenq_mda)
-                    else:
-                        failed_count += 1
-                        print(f"Item 2 not found for {ticker} on {filing.filing_date}")
-                except Exception as e:
-                    print(f"Error processing filing for {ticker} on {filing.filing_date}: {e}")
-        except Exception as e:
-            print(f"Error fetching filings for {ticker}: {e}")
+    _report_mda(results)
 
-    print("Cycle Complete")
-    print(f"Saved {saved_count} text files")
-    print(f"Failed to save {failed_count} MDA extracts")
-    print(f"Successfully saved {(1 - (failed_count/saved_count))*100:.2f} percentage of documents")
+    return results
+
+def fetch_all(tickers: list, start_year: int, output_folder="mda_texts", max_workers=4):
+    '''
+    Runs the MD&A stage concurrently with the assets and prices stages.  Prices only need the filing dates, so they are
+    downloaded in one batch as soon as the assets are in while the MD&A is still being fetched.  All stages share the
+    same EDGAR rate limiter so the combined request rate stays within SEC's policy.
+    :param tickers: list of strings of stock ticker identifiers
+    :param start_year: year to begin grabbing filings
+    :param output_folder: string folder name of the MD&A sync manifest
+    :param max_workers: number of tickers fetched concurrently by each stage
+    :return: data frame of assets, dictionary of filing dates and data frame of prices
+    '''
+    os.makedirs(output_folder, exist_ok=True)
+    corpus = get_corpus()
+    manifest = MdaManifest(output_folder, corpus)
+
+    with ThreadPoolExecutor(max_workers=1) as stages:
+        mda = stages.submit(run_per_ticker, tickers,
+                            lambda ticker: get_ticker_mda(ticker, start_year, output_folder, manifest, corpus),
+                            max_workers, "MD&A")
+        final_assets, ticker_dates = get_assets(tickers, start_year, max_workers=max_workers)
+        final_prices = get_prices(ticker_dates)
+        mda_results = mda.result()
+
+    _report_mda(mda_results)
+
+    return final_assets, ticker_dates, final_prices
 
 def main():
+    serve_from_env()
 
     # Keep track of how long the process runs
     start_time = time.time()
 
     # Set identity to your name and email, not a credential but for record keeping
+    from edgar import set_identity
     set_identity("Mitchell Hornsby hornsby.m@northeastern.edu")
 
     # Company tickers of the constituents of the DJIA since 2009 including adds/drops
-    tickers = ["AAPL", "AMGN", "AMZN", "AXP", "BA", "CAT", "CRM", "CSCO", "CVX", "DIS",
-               "GS", "HD", "HON", "IBM", "JNJ", "JPM", "KO", "MCD", "MMM", "MRK",
-               "MSFT", "NKE", "PG", "TRV", "UNH", "V", "VZ", "WMT", "SHW", "NVDA",
-               "INTC", "DOW", "GE", "T", "HPQ", "BAC", "AA", "XOM", "PFE", "RTX"]
+    tickers = DJIA_TICKERS
 
     # Define start year for grabbing filings and prices
     start_year = 2016
 
-    # Get assets and filing dates since beginning start_year
-    final_assets, ticker_dates = get_assets(tickers, start_year)
-
-    # Get prices from yahoo finance for filing dates
-    final_prices = get_prices(ticker_dates)
-
-    # Get 10-Q MD&A text
-    get_mda_as_txt(tickers, start_year)
+    # Get assets, prices from yahoo finance for filing dates and the 10-Q MD&A text concurrently
+    final_assets, ticker_dates, final_prices = fetch_all(tickers, start_year)
 
     # Report how long process took end to end
     elapsed_time = time.time() - start_time
@@ -246,4 +447,4 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
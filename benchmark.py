@@ -0,0 +1,321 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+# Stages are run from a scratch folder against fixtures generated there, nothing is fetched from EDGAR or Yahoo.
+# Each stage runs in a fresh process so its peak RSS is not inflated by the stages before it.
+
+STAGES = ["assets", "assets_bulk", "prices", "mda", "preprocess", "finbert", "faiss"]
+
+# Words the synthetic MD&A is drawn from, a mix of boilerplate and the vocabulary FinBERT reacts to
+_WORDS = ("revenue net sales increased decreased compared prior year quarter primarily due higher lower demand "
+          "operating income margin gross costs expenses results liquidity capital resources cash flows "
+          "operations investing financing activities growth decline impairment restructuring guidance outlook "
+          "uncertainty risk inflation interest rates foreign currency exchange segment products services customers "
+          "supply chain inventory backlog strong weak favorable unfavorable record loss profit dividend repurchase "
+          "debt credit facility covenant tax effective rate million billion percent fiscal").split()
+
+_HEADINGS = ("Overview", "Results of Operations", "Net Sales", "Operating Expenses", "Liquidity and Capital Resources",
+             "Critical Accounting Estimates", "Recent Accounting Pronouncements")
+
+
+def _synthetic_mda(rng, words):
+    # Headed sections of paragraphs, roughly shaped like an Item 2
+    paragraphs = []
+    remaining = words
+    while remaining > 0:
+        paragraphs.append(rng.choice(_HEADINGS))
+        for _ in range(rng.randint(2, 5)):
+            length = min(remaining, rng.randint(40, 160))
+            sentence = " ".join(rng.choice(_WORDS) for _ in range(length))
+            paragraphs.append(sentence.capitalize() + ".")
+            remaining -= length
+            if remaining <= 0:
+                break
+    return "\n\n".join(paragraphs)
+
+
+def _quarter_dates(start_year, filings):
+    # Filing dates a few weeks after each quarter end, newest last
+    dates = []
+    year, month = start_year, 5
+    for _ in range(filings):
+        dates.append(f"{year}-{month:02d}-{random.Random(year * 12 + month).randint(1, 9):02d}")
+        month += 3
+        if month > 12:
+            year, month = year + 1, month - 12
+    return dates
+
+
+def build_fixtures(workdir, tickers, filings, words, start_year, seed=0):
+    '''
+    Generate the recorded inputs every stage reads: per-company facts Parquet files and a bulk facts table for the
+    assets stages, a daily price file for the prices stage, seeded cache entries standing in for the EDGAR filing
+    index and parsed 10-Qs, a folder of synthetic MD&A text files and the same texts in an MD&A corpus for indexing.
+    :param workdir: string folder to generate the fixtures in, anything already in it is removed
+    :param tickers: list of strings of stock ticker identifiers, they must be in company_tickers.json
+    :param filings: number of 10-Q filings per ticker
+    :param words: number of words per MD&A document
+    :param start_year: year of the first filing
+    :param seed: random seed, the same arguments always produce the same fixtures
+    :return: dictionary describing the fixtures
+    '''
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    from bulk_ingest import FACTS_SCHEMA
+    from response_cache import ResponseCache
+    from storage import MdaCorpus
+    from ticker_lookup import ticker_to_cik
+
+    # Start from an empty folder so no output of an earlier run is picked up
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    rng = random.Random(seed)
+    dates = _quarter_dates(start_year, filings)
+
+    # Company facts, a few concepts per filing with restated duplicates as in the real data
+    os.makedirs(os.path.join(workdir, "facts_cache"), exist_ok=True)
+    for ticker in tickers:
+        rows = {name: [] for name in FACTS_SCHEMA.names}
+        for i, filed in enumerate(dates):
+            end = (pd.Timestamp(filed) - pd.DateOffset(days=35)).strftime("%Y-%m-%d")
+            for concept in ("Assets", "Liabilities", "Revenues", "NetIncomeLoss"):
+                for restated in (0, 1):
+                    rows["namespace"].append("us-gaap")
+                    rows["fact"].append(concept)
+                    rows["unit"].append("USD")
+                    rows["val"].append(rng.uniform(1e8, 1e11))
+                    rows["accn"].append(f"{ticker_to_cik(ticker):010d}-{i:02d}-{restated:06d}")
+                    rows["start"].append(None)
+                    rows["end"].append(end)
+                    rows["fy"].append(int(filed[:4]))
+                    rows["fp"].append(f"Q{i % 3 + 1}")
+                    rows["form"].append("10-Q")
+                    rows["filed"].append(dates[min(i + 4 * restated, len(dates) - 1)])
+                    rows["frame"].append(None)
+        table = pa.table(rows, schema=FACTS_SCHEMA)
+        # load_company_facts writes edgartools' facts table, which has no unit column, the bulk table keeps it
+        pq.write_table(table.drop_columns(["unit"]), os.path.join(workdir, "facts_cache", f"{ticker}.parquet"))
+        partition = os.path.join(workdir, "facts_table", f"cik={ticker_to_cik(ticker)}")
+        os.makedirs(partition, exist_ok=True)
+        pq.write_table(table, os.path.join(partition, "part-0.parquet"))
+
+    # Daily prices on weekdays covering every filing date
+    days = pd.bdate_range(f"{start_year}-01-01", pd.Timestamp(dates[-1]) + pd.DateOffset(days=14))
+    prices = pd.DataFrame({
+        "Date": list(days) * len(tickers),
+        "Ticker": [ticker for ticker in tickers for _ in days],
+        "Adj Close": [100 * (1 + rng.gauss(0, 0.01)) ** i for _ in tickers for i in range(len(days))],
+    })
+    prices.to_parquet(os.path.join(workdir, "prices.parquet"), index=False)
+
+    # EDGAR responses as the pipeline caches them, so the MD&A stage runs from cache only
+    cache = ResponseCache(folder=os.path.join(workdir, "edgar_cache"))
+    os.makedirs(os.path.join(workdir, "mda_fixture"), exist_ok=True)
+    # Kept apart from mda_corpus, which the mda stage fills
+    corpus = MdaCorpus(os.path.join(workdir, "corpus_fixture"))
+    for ticker in tickers:
+        index = [(f"{ticker_to_cik(ticker):010d}-{i:02d}-{900000 + i:06d}", date) for i, date in enumerate(dates)]
+        cache.cached(f"10q-index:{ticker}:{start_year}", lambda: index)
+        for accession_no, date in index:
+            text = _synthetic_mda(rng, words)
+            cache.cached(f"mda:{accession_no}", lambda: text)
+            with open(os.path.join(workdir, "mda_fixture", f"{ticker}_{date}.txt"), "w", encoding="utf-8") as f:
+                f.write(text)
+            corpus.append(ticker, date, accession_no, text)
+    corpus.flush()
+
+    return {"tickers": len(tickers), "filings_per_ticker": filings, "words_per_document": words,
+            "documents": len(tickers) * filings}
+
+
+def _run_stage(stage, workdir, config):
+    # Runs in a fresh process from the fixture folder
+    os.environ["EDGAR_CACHE_DIR"] = os.path.join(workdir, "edgar_cache")
+    os.chdir(workdir)
+
+    from facts_engine import peak_rss_mb
+
+    tickers, start_year = config["tickers"], config["start_year"]
+    documents = []
+    if stage in ("preprocess", "finbert"):
+        for file_name in sorted(os.listdir("mda_fixture")):
+            with open(os.path.join("mda_fixture", file_name), encoding="utf-8") as f:
+                documents.append(f.read())
+
+    # Everything a stage needs is imported and loaded before the clock starts
+    if stage in ("assets", "assets_bulk", "prices", "mda"):
+        from ProjectEdgarGetData import get_assets, get_mda_as_txt, get_prices
+        _, ticker_dates = get_assets(tickers, start_year, facts_table="facts_table")
+    elif stage == "preprocess":
+        from sentiment_analysis import preprocess_text
+    elif stage == "finbert":
+        from sentiment_analysis import get_finbert, score_documents
+        tokenizer, model = get_finbert(config["model"])
+    elif stage == "faiss":
+        # The layout is read when vector_index is imported
+        os.environ["FAISS_INDEX"] = config["faiss_index"]
+        from embedding_cache import HashingEmbeddings
+        from mda_chunker import MDAChunker
+        from storage import MdaCorpus
+        from vector_index import update_vector_store
+        corpus = MdaCorpus("corpus_fixture")
+        embeddings = HashingEmbeddings()
+    baseline_rss = peak_rss_mb()
+
+    start_time = time.time()
+    if stage == "assets":
+        _, dates = get_assets(tickers, start_year, max_workers=config["max_workers"])
+        items, unit = sum(len(d) for d in dates.values()), "filings"
+    elif stage == "assets_bulk":
+        _, dates = get_assets(tickers, start_year, facts_table="facts_table")
+        items, unit = sum(len(d) for d in dates.values()), "filings"
+    elif stage == "prices":
+        items, unit = len(get_prices(ticker_dates, prices_file="prices.parquet")), "rows"
+    elif stage == "mda":
+        results = get_mda_as_txt(tickers, start_year, "mda_out", max_workers=config["max_workers"])
+        items, unit = sum(saved + skipped for saved, skipped, _ in results.values()), "filings"
+    elif stage == "preprocess":
+        for document in documents:
+            preprocess_text(document)
+        items, unit = sum(len(document.split()) for document in documents), "words"
+    elif stage == "finbert":
+        _, stats = score_documents(documents, tokenizer, model, batch_size=config["batch_size"])
+        items, unit = stats["windows"], "windows"
+    elif stage == "faiss":
+        # One ticker at a time as the app and pipeline index them: the first builds the index, later ones add to it
+        # and a layout that needs training is rebuilt once the store is large enough
+        items = sum(update_vector_store(corpus, "vector_store", ticker, start_year, MDAChunker(), embeddings)
+                    for ticker in tickers)
+        unit = "chunks"
+    elapsed = time.time() - start_time
+
+    peak = peak_rss_mb()
+    return {
+        "wall_s": round(elapsed, 4),
+        "items": items,
+        "unit": unit,
+        "throughput": round(items / max(elapsed, 1e-9), 2),
+        "peak_rss_mb": round(peak, 1) if peak is not None else None,
+        "setup_rss_mb": round(baseline_rss, 1) if baseline_rss is not None else None,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(stages, workdir, config):
+    '''
+    Run each stage against the fixtures in its own process.
+    :param stages: names of the stages to run
+    :param workdir: string folder holding the fixtures
+    :param config: dictionary of the run's settings
+    :return: dictionary of stage name to its measurements, or to an error when the stage could not run
+    '''
+    results = {}
+    # Spawned processes need the repository on their path to import the pipeline modules
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)),
+                                                             os.environ.get("PYTHONPATH")]))
+    for stage in stages:
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+            try:
+                results[stage] = pool.submit(_run_stage, stage, workdir, config).result()
+                result = results[stage]
+                print(f"{stage:12s} {result['wall_s']:8.3f}s {result['throughput']:12.1f} {result['unit']}/s "
+                      f"peak RSS {result['peak_rss_mb']} MB")
+            except Exception as e:
+                results[stage] = {"error": f"{type(e).__name__}: {e}"}
+                print(f"{stage:12s} failed: {e}")
+    return results
+
+
+def compare(baseline_path, results):
+    '''
+    Print the change in wall time and peak RSS of every stage against an earlier results file.
+    :param baseline_path: path of an earlier results JSON
+    :param results: dictionary of stage name to measurements of this run
+    '''
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline.get('commit')} ({baseline_path})")
+    for stage, result in results.items():
+        before = baseline["stages"].get(stage, {})
+        if "wall_s" not in result or "wall_s" not in before:
+            continue
+        change = (result["wall_s"] / max(before["wall_s"], 1e-9) - 1) * 100
+        print(f"{stage:12s} {before['wall_s']:8.3f}s -> {result['wall_s']:8.3f}s ({change:+.1f}%), "
+              f"peak RSS {before.get('peak_rss_mb')} -> {result.get('peak_rss_mb')} MB")
+
+
+def main():
+    from ProjectEdgarGetData import DJIA_TICKERS
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages offline against generated fixtures")
+    parser.add_argument("--stages", nargs="*", default=STAGES, choices=STAGES)
+    parser.add_argument("--tickers", type=int, default=5, help="number of tickers in the fixtures")
+    parser.add_argument("--filings", type=int, default=8, help="10-Q filings per ticker")
+    parser.add_argument("--words", type=int, default=3000, help="words per synthetic MD&A document")
+    parser.add_argument("--start-year", type=int, default=2016)
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--model", default="ProsusAI/finbert", help="FinBERT name or a local model folder")
+    parser.add_argument("--faiss-index", default=os.environ.get("FAISS_INDEX", "Flat"),
+                        help="faiss.index_factory layout the faiss stage builds, e.g. IVF64,Flat")
+    parser.add_argument("--workdir", default=os.path.join("benchmarks", "work"))
+    parser.add_argument("--output", default=None, help="results JSON, defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare with")
+    args = parser.parse_args()
+
+    config = {
+        "tickers": DJIA_TICKERS[:args.tickers],
+        "start_year": args.start_year,
+        "max_workers": args.max_workers,
+        "batch_size": args.batch_size,
+        "model": args.model,
+        "faiss_index": args.faiss_index,
+    }
+    workdir = os.path.abspath(args.workdir)
+    start_time = time.time()
+    fixtures = build_fixtures(workdir, config["tickers"], args.filings, args.words, args.start_year)
+    print(f"Built fixtures for {fixtures['documents']} filings in {time.time() - start_time:.2f}s")
+
+    results = run_benchmarks(args.stages, workdir, config)
+
+    commit = _git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "fixtures": fixtures,
+        "stages": results,
+    }
+    output = args.output or os.path.join("benchmarks", "results", f"{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+# Cold start of the entry points, measured with python -X importtime in a fresh interpreter per run.  The budgets are
+# in seconds of total import time and leave room for slower machines; the heavy libraries must not be imported at all
+# until a stage uses them, whatever the machine.
+
+ENTRY_POINTS = {
+    "app": 1.5,
+    "ProjectEdgarGetData": 1.2,
+    "pipeline": 1.2,
+}
+
+# Loaded on first use by the functions that need them, never when an entry point starts
+DEFERRED = ("torch", "transformers", "nltk", "sklearn", "scipy", "faiss", "edgar", "yfinance", "langchain",
+            "langchain_core", "langchain_community", "langchain_openai", "openai", "sentence_transformers")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_importtime(output):
+    '''
+    Read the report python -X importtime writes to stderr.
+    :param output: string stderr of the interpreter, other log lines are skipped
+    :return: list of (module, depth, self seconds, cumulative seconds) in the order reported
+    '''
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(self_time) / 1e6, int(cumulative) / 1e6))
+    return imports
+
+
+def measure(module, runs=5):
+    '''
+    Import a module in fresh interpreters and time it.
+    :param module: string module name, run from the repository folder
+    :param runs: number of timed runs, after one run that compiles the bytecode
+    :return: dict with the median total import time, the slowest packages and the deferred libraries it imported
+    '''
+    totals = []
+    for run in range(runs + 1):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=ROOT,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+        imports = parse_importtime(result.stderr)
+        if run:
+            totals.append(sum(cumulative for _, depth, _, cumulative in imports if depth == 0))
+
+    # Packages by the time their import took, wherever in the tree they were first imported
+    packages = {}
+    for name, _, _, cumulative in imports:
+        if "." not in name and name != module:
+            packages[name] = max(packages.get(name, 0), cumulative)
+    return {
+        "seconds": statistics.median(totals),
+        "slowest": sorted(packages.items(), key=lambda item: -item[1])[:5],
+        "deferred": sorted({name.split(".")[0] for name, _, _, _ in imports} & set(DEFERRED)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the cold start import time of the app and the data CLIs")
+    parser.add_argument("--entry-points", nargs="*", default=list(ENTRY_POINTS), choices=list(ENTRY_POINTS))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every budget, e.g. 2 on a slow CI runner")
+    args = parser.parse_args()
+
+    failed = []
+    for module in args.entry_points:
+        budget = ENTRY_POINTS[module] * args.scale
+        result = measure(module, args.runs)
+        over = result["seconds"] > budget
+        print(f"{module}: {result['seconds']:.3f}s of {budget:.2f}s budget{' OVER BUDGET' if over else ''}")
+        print("  slowest: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in result["slowest"]))
+        if over:
+            failed.append(f"{module} took {result['seconds']:.3f}s, over its {budget:.2f}s budget")
+        if result["deferred"]:
+            print(f"  imports at start: {', '.join(result['deferred'])}")
+            failed.append(f"{module} imports {', '.join(result['deferred'])} at start")
+
+    if failed:
+        print("\n".join(["Import budget failed:"] + [f"  {reason}" for reason in failed]))
+        sys.exit(1)
+    print("All entry points within budget")
+
+
+if __name__ == "__main__":
+    main()
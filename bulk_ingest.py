@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import re
+import shutil
+import time
+import zipfile
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from ticker_lookup import cik_to_ticker, ticker_to_cik
+
+# Nightly archives are published at
+#   https://www.sec.gov/Archives/edgar/daily-index/xbrl/companyfacts.zip
+#   https://www.sec.gov/Archives/edgar/daily-index/bulkdata/submissions.zip
+# and are read here from a local copy, no network is used.
+
+FACTS_SCHEMA = pa.schema([
+    ("namespace", pa.string()),
+    ("fact", pa.string()),
+    ("unit", pa.string()),
+    ("val", pa.float64()),
+    ("accn", pa.string()),
+    ("start", pa.string()),
+    ("end", pa.string()),
+    ("fy", pa.int64()),
+    ("fp", pa.string()),
+    ("form", pa.string()),
+    ("filed", pa.string()),
+    ("frame", pa.string()),
+])
+
+SUBMISSIONS_SCHEMA = pa.schema([
+    ("cik", pa.int64()),
+    ("form", pa.string()),
+    ("filingDate", pa.string()),
+    ("reportDate", pa.string()),
+    ("accessionNumber", pa.string()),
+    ("primaryDocument", pa.string()),
+])
+
+_MEMBER_CIK = re.compile(r"CIK(\d{10})")
+
+
+def _members(archive, ciks=None):
+    # Yield (cik, member) for the JSON members, optionally only for some CIKs
+    for info in archive.infolist():
+        match = _MEMBER_CIK.match(os.path.basename(info.filename))
+        if match is None or not info.filename.endswith(".json"):
+            continue
+        cik = int(match.group(1))
+        if ciks is None or cik in ciks:
+            yield cik, info
+
+
+def _flatten_facts(fjson):
+    '''
+    Flatten one company's companyfacts JSON into columns.
+    :param fjson: parsed CIK##########.json member
+    :return: dictionary of column name to list of values, matching FACTS_SCHEMA
+    '''
+    columns = {name: [] for name in FACTS_SCHEMA.names}
+    for namespace, namespace_json in fjson.get("facts", {}).items():
+        for fact, fact_json in namespace_json.items():
+            for unit, values in fact_json.get("units", {}).items():
+                for value in values:
+                    val = value.get("val")
+                    columns["namespace"].append(namespace)
+                    columns["fact"].append(fact)
+                    columns["unit"].append(unit)
+                    columns["val"].append(float(val) if isinstance(val, (int, float)) else None)
+                    columns["accn"].append(value.get("accn"))
+                    columns["start"].append(value.get("start"))
+                    columns["end"].append(value.get("end"))
+                    columns["fy"].append(value.get("fy"))
+                    columns["fp"].append(value.get("fp"))
+                    columns["form"].append(value.get("form"))
+                    columns["filed"].append(value.get("filed"))
+                    columns["frame"].append(value.get("frame"))
+    return columns
+
+
+def ingest_companyfacts(zip_path, out_dir="facts_table", ciks=None):
+    '''
+    Convert SEC's bulk companyfacts.zip into a Parquet facts table partitioned by CIK.  Members are read one at a time
+    straight out of the archive, so nothing is extracted to disk and only one company is in memory at once.
+    :param zip_path: path of a local companyfacts.zip
+    :param out_dir: string folder name of the facts table, laid out as cik=<cik>/part-0.parquet
+    :param ciks: optional set of integer CIKs to ingest, all companies when None
+    :return: number of companies written
+    '''
+    start_time = time.time()
+    written = 0
+    with zipfile.ZipFile(zip_path) as archive:
+        for cik, info in _members(archive, ciks):
+            with archive.open(info) as member:
+                columns = _flatten_facts(json.load(member))
+            if not columns["fact"]:
+                continue
+
+            partition = os.path.join(out_dir, f"cik={cik}")
+            # Replace the whole partition so a re-ingest never leaves stale files behind
+            if os.path.exists(partition):
+                shutil.rmtree(partition)
+            os.makedirs(partition)
+            pq.write_table(pa.table(columns, schema=FACTS_SCHEMA), os.path.join(partition, "part-0.parquet"))
+
+            written += 1
+            if written % 500 == 0:
+                print(f"Ingested facts for {written} companies in {time.time() - start_time:.0f}s")
+
+    print(f"Ingested facts for {written} companies in {time.time() - start_time:.2f}s")
+    return written
+
+
+def ingest_submissions(zip_path, out_path="submissions.parquet", ciks=None):
+    '''
+    Convert SEC's bulk submissions.zip into a single Parquet table of filings.  The paged members
+    (CIK##########-submissions-001.json) hold older filings and are included.
+    :param zip_path: path of a local submissions.zip
+    :param out_path: path of the Parquet file to write
+    :param ciks: optional set of integer CIKs to ingest, all companies when None
+    :return: number of filings written
+    '''
+    start_time = time.time()
+    writer = pq.ParquetWriter(out_path, SUBMISSIONS_SCHEMA)
+    total = 0
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            for cik, info in _members(archive, ciks):
+                with archive.open(info) as member:
+                    data = json.load(member)
+                # Main members nest the filings under filings/recent, paged members are the filings themselves
+                filings = data["filings"]["recent"] if "filings" in data else data
+                count = len(filings.get("form", []))
+                if not count:
+                    continue
+                writer.write_table(pa.table({
+                    "cik": [cik] * count,
+                    "form": filings["form"],
+                    "filingDate": filings["filingDate"],
+                    "reportDate": filings.get("reportDate", [None] * count),
+                    "accessionNumber": filings["accessionNumber"],
+                    "primaryDocument": filings.get("primaryDocument", [None] * count),
+                }, schema=SUBMISSIONS_SCHEMA))
+                total += count
+    finally:
+        writer.close()
+
+    print(f"Ingested {total} filings in {time.time() - start_time:.2f}s")
+    return total
+
+
+def read_facts(tickers, concepts=("Assets",), forms=("10-Q", "10-K"), start_year=None, facts_table="facts_table"):
+    '''
+    Answer a whole ticker list from the facts table in one pass.  The CIK filter prunes partitions and the concept,
+    form and filed date filters are pushed into the Parquet scan; duplicates are then resolved per company, concept and
+    period end by keeping the first filed value, as get_assets does.
+    :param tickers: list of strings of stock ticker identifiers
+    :param concepts: XBRL concept names to extract
+    :param forms: filing forms to keep
+    :param start_year: year to begin grabbing filings, None keeps all years
+    :param facts_table: string folder name of the facts table
+    :return: data frame of facts with a Ticker column
+    '''
+    ciks = {ticker_to_cik(ticker): ticker.upper() for ticker in tickers if ticker_to_cik(ticker) is not None}
+
+    dataset = ds.dataset(facts_table, format="parquet", partitioning="hive")
+    expression = ds.field("cik").isin(list(ciks)) & ds.field("fact").isin(list(concepts)) \
+        & ds.field("form").isin(list(forms))
+    if start_year is not None:
+        expression = expression & (ds.field("filed") >= f"{start_year}-01-01")
+
+    df = dataset.to_table(columns=["cik", "fact", "val", "accn", "end", "fy", "fp", "form", "filed"],
+                          filter=expression).to_pandas()
+
+    df["filed"] = pd.to_datetime(df["filed"])
+    df["end"] = pd.to_datetime(df["end"])
+    df.sort_values(by=["cik", "fact", "end", "filed", "accn"], kind="stable", inplace=True)
+    df.drop_duplicates(subset=["cik", "fact", "end"], keep="first", inplace=True)
+    df["Ticker"] = df["cik"].map(ciks).fillna(df["cik"].map(cik_to_ticker))
+    df.reset_index(drop=True, inplace=True)
+
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest SEC bulk companyfacts.zip / submissions.zip archives")
+    parser.add_argument("--companyfacts", help="path of a local companyfacts.zip")
+    parser.add_argument("--submissions", help="path of a local submissions.zip")
+    parser.add_argument("--facts-table", default="facts_table")
+    parser.add_argument("--submissions-out", default="submissions.parquet")
+    parser.add_argument("--tickers", nargs="*", help="only ingest these tickers")
+    args = parser.parse_args()
+
+    ciks = None
+    if args.tickers:
+        ciks = {ticker_to_cik(ticker) for ticker in args.tickers} - {None}
+
+    if args.companyfacts:
+        ingest_companyfacts(args.companyfacts, args.facts_table, ciks)
+    if args.submissions:
+        ingest_submissions(args.submissions, args.submissions_out, ciks)
+
+
+if __name__ == "__main__":
+    main()
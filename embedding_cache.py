@@ -0,0 +1,214 @@
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from metrics import METRICS, serve_from_env
+from storage import file_lock, get_corpus
+
+
+class CachedEmbeddings(Embeddings):
+    '''
+    Wraps any langchain embeddings and keeps every vector it produces on disk, keyed by a hash of the model name and
+    the text.  Vectors live in one append-only float32 file that is read through a memory map, with a SQLite index of
+    key to row.  Only texts that were never embedded with this model are sent to the backend, in batches that run
+    with bounded concurrency.
+    :param embeddings: langchain embeddings doing the actual work
+    :param model_name: name of the backend model, part of the cache key
+    :param folder: string folder name to keep the vectors and index in
+    :param batch_size: number of texts per backend call
+    :param max_concurrency: number of backend calls in flight at once
+    '''
+
+    def __init__(self, embeddings, model_name, folder="embedding_cache", batch_size=256, max_concurrency=4):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        os.makedirs(folder, exist_ok=True)
+
+        safe_name = re.sub(r"[^\w.-]", "_", model_name)
+        self.vectors_path = os.path.join(folder, f"{safe_name}.f32")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(folder, f"{safe_name}.db"), check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS vectors (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._db.commit()
+        row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim = row[0] if row else None
+        self._memmap = None
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _rows(self):
+        # Re-map the file only when it has grown since the last read
+        count = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+        if self._memmap is None or len(self._memmap) != count:
+            self._memmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim)) \
+                if count else np.zeros((0, self.dim), dtype=np.float32)
+        return self._memmap
+
+    def _lookup(self, keys):
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                found.update(self._db.execute(
+                    f"SELECT key, row FROM vectors WHERE key IN ({placeholders})", chunk).fetchall())
+        return found
+
+    def _append(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # The app and the pipeline may append to the same cache, so the rows are worked out and written under a lock
+        # held across processes, otherwise the keys of one writer could point at the vectors of the other
+        with self._lock, file_lock(f"{self.vectors_path}.lock"):
+            if self.dim is None:
+                row = self._db.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+                self.dim = row[0] if row else vectors.shape[1]
+                self._db.execute("INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (self.dim,))
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"{self.model_name} returned {vectors.shape[1]} dimensions, "
+                                 f"the cache holds {self.dim}")
+            start = os.path.getsize(self.vectors_path) // (4 * self.dim) if os.path.exists(self.vectors_path) else 0
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            self._db.executemany("INSERT OR REPLACE INTO vectors VALUES (?, ?)",
+                                 [(key, start + i) for i, key in enumerate(keys)])
+            self._db.commit()
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(set(keys)))
+
+        # Embed each distinct uncached text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        METRICS.inc("embedding_texts_total", len(texts) - len(missing), model=self.model_name, result="cached")
+        METRICS.inc("embedding_texts_total", len(missing), model=self.model_name, result="embedded")
+        if missing:
+            missing_keys = list(missing)
+            batches = [missing_keys[i:i + self.batch_size] for i in range(0, len(missing_keys), self.batch_size)]
+
+            def embed(batch):
+                with METRICS.timer("embedding_seconds", model=self.model_name):
+                    return self.embeddings.embed_documents([missing[k] for k in batch])
+
+            with ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="embed") as pool:
+                for batch, vectors in zip(batches, pool.map(embed, batches)):
+                    self._append(batch, vectors)
+            found = self._lookup(list(set(keys)))
+
+        with self._lock:
+            rows = self._rows()
+            return [rows[found[key]].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class LocalEmbeddings(Embeddings):
+    '''
+    CPU embedding model from sentence-transformers, a drop-in replacement for OpenAIEmbeddings that needs no network
+    once the model is on disk.
+    :param model_name: sentence-transformers model name or local path
+    :param batch_size: number of texts encoded at once
+    '''
+
+    def __init__(self, model_name="sentence-transformers/all-MiniLM-L6-v2", batch_size=64):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts):
+        return self.model.encode(list(texts), batch_size=self.batch_size, normalize_embeddings=True).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class HashingEmbeddings(Embeddings):
+    '''
+    Feature hashing of word counts into a fixed size, L2 normalised vector.  It is not a semantic model but it is
+    deterministic, needs no download at all and is cheap, which makes it useful for benchmarking the indexing path
+    offline.
+    :param dim: size of the vectors
+    '''
+
+    def __init__(self, dim=384):
+        from sklearn.feature_extraction.text import HashingVectorizer
+
+        self.dim = dim
+        self.vectorizer = HashingVectorizer(n_features=dim, alternate_sign=False, norm="l2")
+
+    def embed_documents(self, texts):
+        return self.vectorizer.transform(list(texts)).toarray().astype(np.float32).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def get_embeddings(backend=None, folder="embedding_cache"):
+    '''
+    Build the cached embeddings for a backend.
+    :param backend: 'openai', 'local' or 'hashing', defaults to the EMBEDDINGS_BACKEND environment variable or openai
+    :param folder: string folder name of the embedding cache
+    :return: CachedEmbeddings wrapping the backend
+    '''
+    backend = backend or os.environ.get("EMBEDDINGS_BACKEND", "openai")
+    if backend == "openai":
+        from langchain_openai import OpenAIEmbeddings
+
+        embeddings = OpenAIEmbeddings()
+        model_name = f"openai-{embeddings.model}"
+    elif backend == "local":
+        model_name = os.environ.get("LOCAL_EMBEDDINGS_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+        embeddings = LocalEmbeddings(model_name)
+    elif backend == "hashing":
+        embeddings = HashingEmbeddings()
+        model_name = f"hashing-{embeddings.dim}"
+    else:
+        raise ValueError(f"Unknown embeddings backend: {backend}")
+
+    return CachedEmbeddings(embeddings, model_name, folder=folder)
+
+
+def main():
+    # Benchmark embedding the MD&A corpus cold and then warm from the cache
+    from langchain.text_splitter import CharacterTextSplitter
+
+    parser = argparse.ArgumentParser(description="Benchmark the embedding cache on the MD&A corpus")
+    parser.add_argument("--corpus", default="mda_corpus")
+    parser.add_argument("--backend", default="hashing", choices=["openai", "local", "hashing"])
+    parser.add_argument("--cache", default="embedding_cache")
+    args = parser.parse_args()
+    serve_from_env()
+
+    text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    texts = []
+    for text in get_corpus(args.corpus).read()["text"]:
+        texts.extend(text_splitter.split_text(text))
+
+    embeddings = get_embeddings(args.backend, folder=args.cache)
+    for run in ("first", "second"):
+        start_time = time.time()
+        embeddings.embed_documents(texts)
+        elapsed = time.time() - start_time
+        print(f"{run} run: {len(texts)} chunks in {elapsed:.2f}s ({len(texts) / max(elapsed, 1e-9):.0f} chunks/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import time
+import os
+
+from fetch_utils import EDGARTOOLS_REQUESTS, SEC_LIMITER, with_retries
+from metrics import METRICS
+from response_cache import FACTS_TTL
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Columns needed to extract and deduplicate a concept, everything else is left on disk
+FACTS_COLUMNS = ["fact", "val", "accn", "end", "fy", "fp", "form", "filed"]
+
+
+def peak_rss_mb():
+    '''
+    High-water mark of the whole process.  It never goes down and covers every thread, so with several tickers
+    extracted at once it is not the memory of any one of them, see the 'ticker_mb' stat of extract_concepts for that.
+    :return: peak resident memory of the process in MB, or None where the platform does not report it
+    '''
+    if resource is None:
+        return None
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_company_facts(ticker: str, folder="facts_cache", max_age=FACTS_TTL):
+    '''
+    Make sure the XBRL facts of a company are on disk as Parquet, fetching them from EDGAR only when the local copy is
+    missing or older than max_age.  edgartools already holds the facts as an Arrow table so they are written straight
+    to Parquet without going through pandas.
+    :param ticker: string stock ticker identifier
+    :param folder: string folder name to keep the Parquet files in
+    :param max_age: seconds before the local copy is refreshed
+    :return: path of the Parquet file
+    '''
+    path = os.path.join(folder, f"{ticker}.parquet")
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+        return path
+
+    os.makedirs(folder, exist_ok=True)
+    # edgartools is only imported once facts actually have to be fetched
+    from edgar import Company
+
+    with METRICS.timer("edgar_fetch_seconds", call="facts"):
+        company = with_retries(Company, ticker, limiter=SEC_LIMITER, tokens=EDGARTOOLS_REQUESTS)
+        facts = with_retries(company.get_facts, limiter=SEC_LIMITER, tokens=EDGARTOOLS_REQUESTS)
+
+    # Write to a temporary file first so a reader never sees a partial file
+    tmp_path = f"{path}.tmp"
+    pq.write_table(facts.facts, tmp_path)
+    os.replace(tmp_path, path)
+
+    return path
+
+
+def extract_concepts(ticker: str, concepts=("Assets",), forms=("10-Q", "10-K"), start_year=None, folder="facts_cache"):
+    '''
+    Pull any set of concepts for a company out of its facts in one pass.  The concept, form and filed date filters are
+    pushed down into the Parquet read so only matching rows of the needed columns are ever materialised, then the
+    result is sorted and deduplicated in place to keep the first filed value for each concept and period end.
+    :param ticker: string stock ticker identifier
+    :param concepts: XBRL concept names to extract, e.g. 'Assets' or 'Liabilities'
+    :param forms: filing forms to keep
+    :param start_year: year to begin grabbing filings, None keeps all years
+    :param folder: string folder name the Parquet files are kept in
+    :return: data frame of the extracted facts and a dictionary of stats on the time and memory it took, where
+    'ticker_mb' is what this extraction held at its peak (the Arrow table and the frame built from it) and
+    'process_peak_rss_mb' the high-water mark of the whole process so far
+    '''
+    start_time = time.time()
+    path = load_company_facts(ticker, folder=folder)
+    load_time = time.time() - start_time
+
+    filters = [("fact", "in", list(concepts)), ("form", "in", list(forms))]
+    if start_year is not None:
+        filters.append(("filed", ">=", f"{start_year}-01-01"))
+
+    extract_start = time.time()
+    table = pq.read_table(path, columns=FACTS_COLUMNS, filters=filters)
+    df = table.to_pandas()
+    # Both are alive at this point, which is the most this extraction holds at once whatever other threads are doing
+    ticker_mb = (table.nbytes + df.memory_usage(deep=True).sum()) / 1024 ** 2
+
+    # Ensure 'filed' and 'end' columns are datetime
+    df["filed"] = pd.to_datetime(df["filed"])
+    df["end"] = pd.to_datetime(df["end"])
+
+    # Keep only the first filed value for each concept and end date
+    df.sort_values(by=["fact", "end", "filed", "accn"], kind="stable", inplace=True)
+    df.drop_duplicates(subset=["fact", "end"], keep="first", inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    df["Ticker"] = ticker
+
+    stats = {
+        "Ticker": ticker,
+        "facts_rows": pq.ParquetFile(path).metadata.num_rows,
+        "rows": len(df),
+        "arrow_mb": table.nbytes / 1024 ** 2,
+        "load_s": load_time,
+        "extract_s": time.time() - extract_start,
+        "ticker_mb": ticker_mb,
+        "process_peak_rss_mb": peak_rss_mb(),
+    }
+
+    return df, stats
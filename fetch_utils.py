@@ -0,0 +1,138 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from metrics import METRICS
+
+
+class RateLimiter:
+    '''
+    Token bucket shared between worker threads so that concurrent fetches stay under a request rate policy.  SEC asks
+    for no more than 10 requests per second, so the default leaves a little headroom.
+    :param rate: tokens added to the bucket per second
+    :param capacity: maximum burst size, defaults to the rate
+    '''
+
+    def __init__(self, rate=8.0, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        '''
+        Block until the requested number of tokens is available and then take them.
+        :param tokens: number of requests about to be made
+        '''
+        # A request costing more than the bucket holds would never get through, it waits for a full bucket instead
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # Refill the bucket for the time that passed since the last call
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            METRICS.observe("rate_limit_wait_seconds", wait)
+            time.sleep(wait)
+
+
+# Shared limiter for everything that talks to sec.gov, one token per HTTP request
+SEC_LIMITER = RateLimiter(rate=8)
+
+# A single edgartools call makes several HTTP requests of its own (Company looks up the ticker and loads the
+# submissions and their older pages, filing.obj reads the filing index and then the document), so it takes this many
+# tokens from the limiter to keep the combined rate under SEC's policy
+EDGARTOOLS_REQUESTS = 4
+
+# Statuses that mean the server is throttling us or having trouble, the request is tried again after a backoff
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def _retry_after(response):
+    '''
+    :param response: HTTP response, or None when the call raised without one
+    :return: seconds the server asked us to wait in its Retry-After header, or None when it did not say
+    '''
+    value = getattr(response, "headers", {}).get("Retry-After") if response is not None else None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        # Retry-After may also be an HTTP date, which is rare enough to just fall back to the backoff
+        return None
+
+
+def with_retries(func, *args, attempts=3, backoff=1.0, limiter=None, tokens=1, **kwargs):
+    '''
+    Call a function and retry it with exponential backoff if it raises or returns a response with a throttling or server
+    error status.  A Retry-After header on such a response is honoured when it asks for a longer wait than the backoff.
+    :param func: callable making the network request
+    :param attempts: total number of tries before the last error is raised or the last response is returned
+    :param backoff: seconds to wait after the first failure, doubled after every further failure
+    :param limiter: optional RateLimiter to take tokens from before every try
+    :param tokens: number of HTTP requests one call of func makes, see EDGARTOOLS_REQUESTS
+    :return: the return value of func
+    '''
+    for attempt in range(attempts):
+        if limiter is not None:
+            limiter.acquire(tokens)
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1:
+                METRICS.inc("request_failures_total")
+                raise
+            # requests attaches the response to an HTTPError raised by raise_for_status
+            response = getattr(e, "response", None)
+        else:
+            if getattr(result, "status_code", None) not in RETRY_STATUSES:
+                return result
+            if attempt == attempts - 1:
+                # Out of tries, the caller decides what to do with the error response
+                METRICS.inc("request_failures_total")
+                return result
+            response = result
+        METRICS.inc("request_retries_total")
+        wait = backoff * (2 ** attempt)
+        time.sleep(max(wait, _retry_after(response) or 0.0))
+
+
+def run_per_ticker(tickers, func, max_workers=4, desc="Fetching"):
+    '''
+    Run func(ticker) for every ticker on a bounded thread pool and print the time each ticker took instead of a
+    progress bar.  Failures are reported and left out of the results so one bad ticker does not stop the rest.
+    :param tickers: iterable of stock ticker identifiers
+    :param func: callable taking a single ticker and returning its result
+    :param max_workers: size of the worker pool
+    :param desc: label printed in front of each timing line
+    :return: dictionary of ticker to result for the tickers that succeeded, in the order of the input
+    '''
+    tickers = list(tickers)
+    results = {}
+    start_time = time.time()
+
+    def timed(ticker):
+        ticker_start = time.time()
+        with METRICS.timer("ticker_seconds", stage=desc):
+            result = func(ticker)
+        return result, time.time() - ticker_start
+
+    # Threads are named after the stage so they can be told apart in py-spy
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=desc) as pool:
+        futures = {pool.submit(timed, ticker): ticker for ticker in tickers}
+        for done, future in enumerate(as_completed(futures), start=1):
+            ticker = futures[future]
+            try:
+                result, elapsed = future.result()
+                results[ticker] = result
+                print(f"{desc} [{done}/{len(tickers)}] {ticker}: {elapsed:.2f}s")
+            except Exception as e:
+                print(f"{desc} [{done}/{len(tickers)}] {ticker}: failed ({e})")
+
+    print(f"{desc}: {len(results)}/{len(tickers)} tickers in {time.time() - start_time:.2f}s")
+
+    return {ticker: results[ticker] for ticker in tickers if ticker in results}
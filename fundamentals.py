@@ -0,0 +1,255 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from facts_engine import load_company_facts
+from fetch_utils import run_per_ticker
+from storage import write_table
+from ticker_lookup import cik_to_ticker, ticker_to_cik
+
+# Balance sheet and income statement concepts most MD&A discussions refer to
+DEFAULT_CONCEPTS = (
+    "Assets",
+    "Liabilities",
+    "StockholdersEquity",
+    "CashAndCashEquivalentsAtCarryingValue",
+    "Revenues",
+    "RevenueFromContractWithCustomerExcludingAssessedTax",
+    "OperatingIncomeLoss",
+    "NetIncomeLoss",
+    "EarningsPerShareDiluted",
+)
+
+# Columns read from the facts, everything else is left on disk
+PANEL_COLUMNS = ["fact", "unit", "val", "accn", "start", "end", "form", "filed"]
+
+# Flow concepts (with a start date) are kept for quarter-long periods only, so year-to-date values in 10-Qs and full
+# years in 10-Ks do not end up in the same column as the quarters
+QUARTER_DAYS = (80, 100)
+
+
+def _scan_facts_table(tickers, concepts, forms, start_year, facts_table):
+    # One dataset scan over the bulk facts table, pruned to the tickers' partitions
+    ciks = [cik for cik in (ticker_to_cik(ticker) for ticker in tickers) if cik is not None]
+    expression = ds.field("cik").isin(ciks) & ds.field("fact").isin(list(concepts)) \
+        & ds.field("form").isin(list(forms))
+    if start_year is not None:
+        expression = expression & (ds.field("filed") >= f"{start_year}-01-01")
+    dataset = ds.dataset(facts_table, format="parquet", partitioning="hive")
+    table = dataset.to_table(columns=PANEL_COLUMNS + ["cik"], filter=expression)
+    tickers_by_cik = pa.array([cik_to_ticker(cik) for cik in pc.unique(table["cik"]).to_pylist()])
+    positions = pc.index_in(table["cik"], pc.unique(table["cik"]))
+    return table.drop_columns(["cik"]).append_column("Ticker", pc.take(tickers_by_cik, positions))
+
+
+def _scan_company_facts(tickers, concepts, forms, start_year, folder, max_workers):
+    # Read each company's cached facts Parquet with the filters pushed down, fetching any that are missing
+    filters = [("fact", "in", list(concepts)), ("form", "in", list(forms))]
+    if start_year is not None:
+        filters.append(("filed", ">=", f"{start_year}-01-01"))
+
+    def read(ticker):
+        path = load_company_facts(ticker, folder=folder)
+        # edgartools' facts table has no unit column, its values are left without a unit
+        columns = [column for column in PANEL_COLUMNS if column in pq.read_schema(path).names]
+        table = pq.read_table(path, columns=columns, filters=filters)
+        if "unit" not in columns:
+            table = table.append_column("unit", pa.nulls(table.num_rows, pa.string()))
+        return table.append_column("Ticker", pa.array([ticker] * table.num_rows, pa.string()))
+
+    tables = run_per_ticker(tickers, read, max_workers=max_workers, desc="Facts")
+    if not tables:
+        return None
+    return pa.concat_tables(list(tables.values()), promote_options="default")
+
+
+def _empty_panel():
+    # Shape of build_panel's result when no facts could be read
+    return pd.DataFrame({
+        "Ticker": pd.Series(dtype="category"),
+        "period_end": pd.Series(dtype="datetime64[ns]"),
+        "filed": pd.Series(dtype="datetime64[ns]"),
+        "restated": pd.Series(dtype="bool"),
+    })
+
+
+def resolve_facts(facts, restatements="original"):
+    '''
+    Keep one value per ticker, concept, unit and period, a missing unit counting as one unit.  A period is its start and end date, so quarterly and
+    year-to-date values of the same end date stay apart, and values in different units are never taken for
+    restatements of each other.  Every filing reporting the period is ranked by filed date, with the accession number
+    breaking ties, and either the first or the last is kept; this does not depend on the order the rows arrived in.
+    :param facts: data frame with Ticker, fact, unit, val, accn, start, end, form and filed columns
+    :param restatements: 'original' keeps the value as first reported, which is what was known on the filing date,
+    'latest' keeps the most recently restated value
+    :return: data frame with one row per ticker, concept, unit and period and a 'restated' flag for periods reported
+    more than once with different values
+    '''
+    if restatements not in ("original", "latest"):
+        raise ValueError(f"restatements must be 'original' or 'latest', not {restatements}")
+
+    keys = ["Ticker", "fact", "unit", "start", "end"]
+    facts = facts.sort_values(keys + ["filed", "accn"], kind="stable", na_position="first", ignore_index=True)
+
+    # Row positions of the first and last filing of every period, the rows of a period are adjacent once sorted
+    first = np.flatnonzero(~facts.duplicated(keys).to_numpy())
+    last = np.append(first[1:] - 1, len(facts) - 1)
+
+    values = facts["val"].to_numpy()
+    resolved = facts.iloc[first if restatements == "original" else last].reset_index(drop=True)
+    resolved["first_filed"] = facts["filed"].to_numpy()[first]
+    resolved["restated"] = ~np.isclose(values[first], values[last], equal_nan=True)
+    return resolved
+
+
+def one_per_period(resolved):
+    '''
+    Reduce resolved facts to one value per ticker, concept and period end, the shape of the panel's cells.  Each
+    ticker's concept is kept in the unit it reports most often, so a column never mixes e.g. USD and shares, and of
+    periods ending on the same day with different start dates, as 52/53 week fiscal calendars and restated period
+    definitions produce, the longest is kept, then the one filed last.
+    :param resolved: data frame from resolve_facts
+    :return: data frame with one row per ticker, concept and period end
+    '''
+    counts = resolved.groupby(["Ticker", "fact", "unit"], dropna=False).size().rename("rows").reset_index()
+    units = counts.sort_values("rows", kind="stable").drop_duplicates(["Ticker", "fact"], keep="last")
+    resolved = resolved.merge(units[["Ticker", "fact", "unit"]], on=["Ticker", "fact", "unit"])
+
+    duration = (resolved["end"] - resolved["start"]).dt.days
+    resolved = resolved.assign(duration=duration).sort_values(["Ticker", "fact", "end", "duration", "filed"],
+                                                              kind="stable", na_position="first")
+    return resolved.drop_duplicates(["Ticker", "fact", "end"], keep="last", ignore_index=True).drop(columns="duration")
+
+
+def build_panel(tickers, concepts=DEFAULT_CONCEPTS, start_year=None, forms=("10-Q", "10-K"), restatements="original",
+                facts_table=None, facts_folder="facts_cache", max_workers=4):
+    '''
+    Wide fundamentals panel with one row per ticker and fiscal period end and one column per concept, extracted in a
+    single pass over the cached facts.  Each row carries the date its filing first made the period public.
+    :param tickers: list of strings of stock ticker identifiers
+    :param concepts: XBRL concept names, one column each
+    :param start_year: year to begin grabbing filings, None keeps all years
+    :param forms: filing forms to keep
+    :param restatements: 'original' or 'latest', see resolve_facts
+    :param facts_table: folder of a bulk facts table built by bulk_ingest, read in one scan without any network
+    :param facts_folder: string folder name of the per-company facts cache used when no facts_table is given
+    :param max_workers: number of companies fetched concurrently when their facts are not cached yet
+    :return: data frame with Ticker, period_end, filed, one float column per concept and a restated flag
+    '''
+    start_time = time.time()
+    if facts_table is not None:
+        table = _scan_facts_table(tickers, concepts, forms, start_year, facts_table)
+    else:
+        table = _scan_company_facts(tickers, concepts, forms, start_year, facts_folder, max_workers)
+    scan_time = time.time() - start_time
+    if table is None or not table.num_rows:
+        print("Fundamentals panel: no facts found")
+        return _empty_panel()
+
+    facts = table.to_pandas()
+    for column in ("start", "end", "filed"):
+        facts[column] = pd.to_datetime(facts[column])
+    facts["val"] = facts["val"].astype("float64")
+
+    # Instants (balance sheet) and quarter-long durations (income statement)
+    duration = (facts["end"] - facts["start"]).dt.days
+    facts = facts[facts["start"].isna() | duration.between(*QUARTER_DAYS)]
+
+    resolved = one_per_period(resolve_facts(facts, restatements))
+
+    # Pivot to ticker x period, the period is public from the first filing reporting any of its concepts
+    index = ["Ticker", "end"]
+    panel = resolved.pivot(index=index, columns="fact", values="val")
+    panel = panel.reindex(columns=[concept for concept in concepts if concept in panel.columns])
+    grouped = resolved.groupby(index, sort=False)
+    panel.insert(0, "filed", grouped["first_filed"].min())
+    panel["restated"] = grouped["restated"].any()
+    panel = panel.reset_index().rename(columns={"end": "period_end"})
+    panel.columns.name = None
+    panel["Ticker"] = panel["Ticker"].astype("category")
+
+    print(f"Fundamentals panel: {panel['Ticker'].nunique()} tickers, {len(panel)} periods, "
+          f"{len(panel.columns) - 4} concepts from {table.num_rows} facts in {time.time() - start_time:.2f}s "
+          f"(scan {scan_time:.2f}s)")
+    return panel.sort_values(["Ticker", "period_end"], ignore_index=True)
+
+
+def join_returns(panel, prices):
+    '''
+    Attach to each period the price and return of the first trading day on or after its filing, as get_prices
+    computes them.
+    :param panel: data frame from build_panel
+    :param prices: data frame from get_prices with Ticker, Date, Adj Close and Interperiod Return Pct columns
+    :return: the panel with Date, Adj Close and Interperiod Return Pct columns added
+    '''
+    prices = prices.assign(Date=pd.to_datetime(prices["Date"]), Ticker=prices["Ticker"].astype(str))
+    joined = pd.merge_asof(
+        panel.assign(Ticker=panel["Ticker"].astype(str)).sort_values("filed"),
+        prices.sort_values("Date"),
+        left_on="filed",
+        right_on="Date",
+        by="Ticker",
+        direction="forward",
+        tolerance=pd.Timedelta(days=7),
+    )
+    joined["Ticker"] = joined["Ticker"].astype("category")
+    return joined.sort_values(["Ticker", "period_end"], ignore_index=True)
+
+
+def get_fundamentals(tickers, start_year, concepts=DEFAULT_CONCEPTS, restatements="original", facts_table=None,
+                     prices=None, prices_file=None, output="fundamentals.parquet"):
+    '''
+    Build the fundamentals panel, join it to the returns around each filing and save it as Parquet.
+    :param tickers: list of strings of stock ticker identifiers
+    :param start_year: year to begin grabbing filings
+    :param concepts: XBRL concept names, one column each
+    :param restatements: 'original' or 'latest', see resolve_facts
+    :param facts_table: folder of a bulk facts table built by bulk_ingest
+    :param prices: data frame from get_prices, computed from the panel's filing dates when not given
+    :param prices_file: optional local price file used instead of downloading, see download_prices
+    :param output: path of the Parquet file to write
+    :return: data frame of the panel with prices and returns
+    '''
+    from ProjectEdgarGetData import get_prices
+
+    panel = build_panel(tickers, concepts, start_year, restatements=restatements, facts_table=facts_table)
+    if prices is None:
+        filed_dates = panel.groupby("Ticker", observed=True)["filed"].apply(
+            lambda dates: sorted(set(dates.dt.strftime("%Y-%m-%d"))))
+        prices = get_prices(filed_dates.to_dict(), prices_file=prices_file)
+    panel = join_returns(panel, prices)
+    write_table(panel, output)
+    return panel
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a wide fundamentals panel joined to filing returns")
+    parser.add_argument("--tickers", nargs="*", help="tickers to include, all of the facts table by default")
+    parser.add_argument("--concepts", nargs="*", default=list(DEFAULT_CONCEPTS))
+    parser.add_argument("--start-year", type=int, default=2016)
+    parser.add_argument("--restatements", choices=["original", "latest"], default="original")
+    parser.add_argument("--facts-table", help="bulk facts table built by bulk_ingest")
+    parser.add_argument("--prices-file", help="local price file instead of downloading")
+    parser.add_argument("--output", default="fundamentals.parquet")
+    args = parser.parse_args()
+
+    tickers = args.tickers
+    if not tickers:
+        if args.facts_table is None:
+            parser.error("--tickers is required without --facts-table")
+        partitions = ds.dataset(args.facts_table, format="parquet", partitioning="hive").files
+        tickers = sorted({cik_to_ticker(path.split("cik=")[1].split("/")[0]) for path in partitions} - {None})
+
+    panel = get_fundamentals(tickers, args.start_year, args.concepts, args.restatements, args.facts_table,
+                             prices_file=args.prices_file, output=args.output)
+    print(panel.head())
+
+
+if __name__ == "__main__":
+    main()
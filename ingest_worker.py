@@ -0,0 +1,148 @@
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+
+class Job:
+    '''
+    State of one ingestion request, read by the UI while the worker updates it.
+    :param ticker: string stock ticker identifier
+    :param start_year: year to begin grabbing filings
+    :param stages: names of the stages the job goes through
+    '''
+
+    def __init__(self, ticker, start_year, stages):
+        self.ticker = ticker
+        self.start_year = start_year
+        self.stages = list(stages)
+        self.status = "queued"
+        self.stage = None
+        self.completed = []
+        self.messages = []
+        self.results = {}
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+
+    @property
+    def key(self):
+        return self.ticker, self.start_year
+
+    @property
+    def progress(self):
+        '''
+        :return: fraction of the stages completed, between 0 and 1
+        '''
+        return len(self.completed) / max(len(self.stages), 1)
+
+    @property
+    def active(self):
+        return self.status in ("queued", "running")
+
+    def report(self, message):
+        '''
+        Add a progress message for the UI.
+        :param message: string to show
+        '''
+        self.messages.append(message)
+
+
+class IngestWorker:
+    '''
+    Runs ingestion jobs on a thread pool in the background of the Streamlit server so no script run waits on EDGAR,
+    FinBERT or FAISS.  A job for a ticker that is already queued or running is not started again, the caller gets the
+    running job to poll, and a finished job is kept and served to every session until it is older than max_age.
+    Threads are used rather than processes so the jobs share the loaded FinBERT model and embeddings cache; stages that
+    write shared files (the MD&A manifest and corpus, the FAISS index) run one job at a time behind a per-stage lock,
+    so jobs for different tickers overlap in their other stages.
+    :param stages: list of (name, func) pairs run in order, func(job) returns the stage's result
+    :param exclusive: names of the stages that must not run for two jobs at once
+    :param max_workers: number of jobs run at once
+    :param max_age: seconds a finished job is served before a request starts a new one
+    '''
+
+    def __init__(self, stages, exclusive=(), max_workers=2, max_age=6 * 60 * 60):
+        self.stages = list(stages)
+        self.max_age = max_age
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stage_locks = {name: threading.Lock() for name in exclusive}
+        self._resources = {}
+        self._resources_lock = threading.Lock()
+
+    def submit(self, ticker, start_year):
+        '''
+        Request the ingestion of a ticker.
+        :param ticker: string stock ticker identifier
+        :param start_year: year to begin grabbing filings
+        :return: the Job doing the work, possibly one another session started
+        '''
+        key = (ticker, start_year)
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and (job.active or (job.status == "done" and time.time() - job.finished < self.max_age)):
+                METRICS.inc("ingest_requests_total", result="deduplicated")
+                return job
+            job = Job(ticker, start_year, [name for name, _ in self.stages])
+            self._jobs[key] = job
+        METRICS.inc("ingest_requests_total", result="submitted")
+        self._pool.submit(self._run, job)
+        return job
+
+    def resource(self, name, factory):
+        '''
+        Object shared by every job, such as a model or an index, created by the first stage that asks for it so nothing
+        is loaded until a job needs it.
+        :param name: string key of the resource
+        :param factory: function without arguments creating the resource
+        :return: the resource
+        '''
+        with self._resources_lock:
+            if name not in self._resources:
+                self._resources[name] = factory()
+            return self._resources[name]
+
+    def loaded(self, name):
+        '''
+        :param name: string key of the resource
+        :return: the resource if a stage created it already, otherwise None
+        '''
+        with self._resources_lock:
+            return self._resources.get(name)
+
+    def get(self, ticker, start_year):
+        '''
+        :return: the latest Job for a ticker or None if it was never requested
+        '''
+        with self._lock:
+            return self._jobs.get((ticker, start_year))
+
+    def _run(self, job):
+        job.status = "running"
+        try:
+            for name, func in self.stages:
+                job.stage = name
+                lock = self._stage_locks.get(name)
+                if lock is not None:
+                    with lock:
+                        job.results[name] = self._run_stage(name, func, job)
+                else:
+                    job.results[name] = self._run_stage(name, func, job)
+                job.completed.append(name)
+            job.status = "done"
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = "failed"
+            traceback.print_exc()
+        finally:
+            job.stage = None
+            job.finished = time.time()
+
+    @staticmethod
+    def _run_stage(name, func, job):
+        with METRICS.timer("ingest_stage_seconds", stage=name):
+            return func(job)
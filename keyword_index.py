@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from metrics import METRICS, serve_from_env
+from storage import file_lock, get_corpus
+
+# Words of two or more letters, numbers and single characters carry nothing about the business
+TOKEN_PATTERN = r"(?u)\b[a-zA-Z][a-zA-Z]+\b"
+
+# Filings hashed at once while updating, bounds the memory of a large backfill
+BATCH_SIZE = 256
+
+
+def _pass_terms(terms):
+    # The terms are produced once by the analyzer, the hasher only maps them to columns
+    return terms
+
+
+class KeywordIndex:
+    '''
+    Persisted TF-IDF index over the MD&A corpus, one row per filing.  Term counts are hashed into a fixed number of
+    columns with a HashingVectorizer, so adding filings never refits anything: new rows are appended to the saved CSR
+    matrix and the IDF weights are recomputed from the document frequencies when the index is queried.  A vocabulary
+    maps each column back to a term, which is what top terms and drift report: the alphabetically first of the terms
+    hashed to it in the batch of filings that first used the column.  Two terms sharing a column are reported under
+    that one.  Queries work on a snapshot of the weights and documents, so an update running meanwhile is not seen
+    half way.  The app and the pipeline may update the same index: updates hold a lock file and start from what is on
+    disk, and the index is re-read whenever another writer saved it.
+    :param folder: string folder name of the saved index
+    :param n_features: number of hashed columns, only used when a new index is created
+    :param ngram_range: lengths of the terms counted, (1, 2) adds phrases such as 'supply chain'
+    '''
+
+    def __init__(self, folder="keyword_index", n_features=2 ** 20, ngram_range=(1, 2)):
+        self.folder = folder
+        self.counts_path = os.path.join(folder, "counts.npz")
+        self.documents_path = os.path.join(folder, "documents.parquet")
+        self.vocabulary_path = os.path.join(folder, "vocabulary.parquet")
+        self.settings_path = os.path.join(folder, "settings.json")
+        self.lock_path = os.path.join(folder, "index.lock")
+        self._lock = threading.Lock()
+        self._weights = None
+        self._stamp = None
+
+        # An existing index keeps the settings it was built with
+        if os.path.exists(self.settings_path):
+            with open(self.settings_path, "r", encoding="utf-8") as f:
+                settings = json.load(f)
+            n_features, ngram_range = settings["n_features"], tuple(settings["ngram_range"])
+        self.n_features = n_features
+        self.ngram_range = tuple(ngram_range)
+        self._analyzer = HashingVectorizer(ngram_range=self.ngram_range, stop_words="english",
+                                           token_pattern=TOKEN_PATTERN).build_analyzer()
+        self._hasher = HashingVectorizer(analyzer=_pass_terms, n_features=n_features, alternate_sign=False,
+                                         norm=None, dtype=np.float32)
+
+        self.vocabulary = np.full(n_features, None, dtype=object)
+        self.documents = pd.DataFrame({
+            "ticker": pd.Series(dtype="string"),
+            "filing_date": pd.Series(dtype="datetime64[ns]"),
+            "accession_no": pd.Series(dtype="string"),
+            "sha256": pd.Series(dtype="string"),
+        })
+        self.counts = sp.csr_matrix((0, n_features), dtype=np.float32)
+        if os.path.exists(self.documents_path):
+            with file_lock(self.lock_path):
+                self._reload()
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _documents_stamp(self):
+        try:
+            stat = os.stat(self.documents_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def _reload(self):
+        # Read the saved index when another writer saved it since it was last read, called with the lock file held
+        stamp = self._documents_stamp()
+        if stamp is None or stamp == self._stamp:
+            return
+        self.documents = pd.read_parquet(self.documents_path)
+        # Rows past the saved documents belong to an update that did not finish
+        self.counts = sp.load_npz(self.counts_path).tocsr()[:len(self.documents)]
+        vocabulary = pq.read_table(self.vocabulary_path).to_pandas()
+        self.vocabulary[vocabulary["column"].to_numpy()] = vocabulary["term"].to_numpy()
+        self._weights = None
+        self._stamp = stamp
+
+    def _hash(self, texts):
+        # One analyzer pass gives both the counts and the terms to add to the vocabulary
+        terms = [self._analyzer(text) for text in texts]
+        counts = self._hasher.transform(terms).tocsr()
+        unique_terms = sorted(set().union(*terms)) if terms else []
+        if unique_terms:
+            columns = self._hasher.transform([[term] for term in unique_terms]).tocsr().indices
+            columns, first = np.unique(columns, return_index=True)
+            new = pd.isna(self.vocabulary[columns])
+            self.vocabulary[columns[new]] = np.asarray(unique_terms, dtype=object)[first[new]]
+        return counts
+
+    def update(self, corpus=None):
+        '''
+        Add the corpus filings that are not in the index yet and save it.
+        :param corpus: MdaCorpus to index, the shared default store if not given
+        :return: number of filings added
+        '''
+        if corpus is None:
+            corpus = get_corpus()
+        os.makedirs(self.folder, exist_ok=True)
+        with self._lock, file_lock(self.lock_path):
+            self._reload()
+            selected = corpus.documents()
+            selected = selected[~selected["accession_no"].isin(self.documents["accession_no"])]
+            if selected.empty:
+                return 0
+
+            with METRICS.timer("keyword_update_seconds"):
+                blocks = [self.counts]
+                for start in range(0, len(selected), BATCH_SIZE):
+                    blocks.append(self._hash(corpus.texts(selected.iloc[start:start + BATCH_SIZE])))
+                self.counts = sp.vstack(blocks, format="csr", dtype=np.float32)
+                self.documents = pd.concat(
+                    [self.documents, selected[["ticker", "filing_date", "accession_no", "sha256"]]],
+                    ignore_index=True)
+                self._weights = None
+                self._save()
+        METRICS.inc("keyword_documents_added_total", len(selected))
+        print(f"Keyword index: {len(selected)} filings added, {len(self.documents)} in total")
+        return len(selected)
+
+    def _save(self):
+        # The documents table is written last, rows of the matrix beyond it are dropped on load
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self.settings_path, "w", encoding="utf-8") as f:
+            json.dump({"n_features": self.n_features, "ngram_range": list(self.ngram_range)}, f)
+
+        tmp_path = os.path.join(self.folder, "counts.tmp.npz")
+        sp.save_npz(tmp_path, self.counts, compressed=False)
+        os.replace(tmp_path, self.counts_path)
+
+        columns = np.flatnonzero(~pd.isna(self.vocabulary))
+        vocabulary = pa.table({"column": pa.array(columns, pa.int32()),
+                               "term": pa.array(self.vocabulary[columns].tolist(), pa.string())})
+        for table, path in ((vocabulary, self.vocabulary_path),
+                            (pa.Table.from_pandas(self.documents, preserve_index=False), self.documents_path)):
+            tmp_path = f"{path}.tmp"
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, path)
+        self._stamp = self._documents_stamp()
+
+    def idf(self):
+        '''
+        :return: smoothed inverse document frequency of every column over the whole corpus
+        '''
+        document_frequency = np.bincount(self.counts.indices, minlength=self.n_features)
+        return (np.log((1 + len(self.documents)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+    def weights(self):
+        '''
+        TF-IDF matrix of the filings: sublinear term frequency times IDF, rows normalised to unit length so the dot
+        product of two rows is their cosine similarity.
+        :return: CSR matrix with one row per filing, in the order of documents
+        '''
+        return self._snapshot()[0]
+
+    def _snapshot(self):
+        # The weights and the documents they were computed for, taken together so their rows match
+        with self._lock:
+            if self._documents_stamp() != self._stamp:
+                with file_lock(self.lock_path):
+                    self._reload()
+            if self._weights is None:
+                weights = self.counts.copy()
+                np.log1p(weights.data, out=weights.data)
+                weights = weights.multiply(self.idf()).tocsr()
+                norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+                self._weights = sp.diags(1 / np.maximum(norms, 1e-12)).dot(weights).tocsr().astype(np.float32)
+            return self._weights, self.documents
+
+    @staticmethod
+    def _rows(documents, ticker=None):
+        # Positions of a ticker's filings, in filing date order
+        if ticker is not None:
+            documents = documents[documents["ticker"] == ticker]
+        return documents.sort_values("filing_date", kind="stable").index.to_numpy()
+
+    def _terms(self, columns):
+        return [term if term is not None else f"#{column}" for column, term in zip(columns, self.vocabulary[columns])]
+
+    def top_terms(self, ticker=None, n=10):
+        '''
+        Terms that set each filing apart from the rest of the corpus.
+        :param ticker: optional ticker to restrict to
+        :param n: number of terms per filing
+        :return: data frame with ticker, filing_date, accession_no, rank, term and weight columns
+        '''
+        weights, documents = self._snapshot()
+        records = []
+        for row in self._rows(documents, ticker):
+            start, end = weights.indptr[row], weights.indptr[row + 1]
+            data, columns = weights.data[start:end], weights.indices[start:end]
+            best = np.argsort(-data, kind="stable")[:n]
+            document = documents.iloc[row]
+            for rank, (term, weight) in enumerate(zip(self._terms(columns[best]), data[best]), start=1):
+                records.append((document["ticker"], document["filing_date"], document["accession_no"], rank, term,
+                                float(weight)))
+        return pd.DataFrame(records, columns=["ticker", "filing_date", "accession_no", "rank", "term", "weight"])
+
+    def term_drift(self, ticker, n=10, lag=1):
+        '''
+        How the language of a ticker's filings changes from one filing to the next.
+        :param ticker: string stock ticker identifier
+        :param n: number of rising and falling terms per filing
+        :param lag: number of filings back to compare with, 1 for quarter over quarter, 3 for the same quarter of the
+        year before when the ticker files three 10-Qs a year
+        :return: data frame with one row per filing: filing_date, previous_date, similarity (cosine, 1 means the same
+        language), rising and falling terms
+        '''
+        weights, documents = self._snapshot()
+        rows = self._rows(documents, ticker)
+        records = []
+        for previous, current in zip(rows[:-lag], rows[lag:]):
+            change = (weights[current] - weights[previous]).tocoo()
+            order = np.argsort(change.data, kind="stable")
+            rising, falling = order[::-1][:n], order[:n]
+            records.append({
+                "filing_date": documents.at[current, "filing_date"],
+                "previous_date": documents.at[previous, "filing_date"],
+                "accession_no": documents.at[current, "accession_no"],
+                "similarity": float(weights[current].multiply(weights[previous]).sum()),
+                "rising": self._terms(change.col[rising[change.data[rising] > 0]]),
+                "falling": self._terms(change.col[falling[change.data[falling] < 0]]),
+            })
+        return pd.DataFrame(records, columns=["filing_date", "previous_date", "accession_no", "similarity", "rising",
+                                              "falling"])
+
+    def search(self, query, ticker=None, k=10):
+        '''
+        Rank filings by the TF-IDF weight of the query's terms, e.g. to narrow a vector search to the filings that
+        mention them.
+        :param query: string of keywords or a question
+        :param ticker: optional ticker to restrict to
+        :param k: number of filings returned
+        :return: data frame of the documents with a score column, best first, only filings containing a query term
+        '''
+        with METRICS.timer("keyword_search_seconds"):
+            weights, documents = self._snapshot()
+            rows = self._rows(documents, ticker)
+            query_vector = self._hasher.transform([self._analyzer(query)]).tocsr()
+            query_vector.data[:] = 1
+            scores = np.asarray(weights[rows].dot(query_vector.T).todense()).ravel()
+            best = np.argsort(-scores, kind="stable")[:k]
+            best = best[scores[best] > 0]
+            return documents.iloc[rows[best]].assign(score=scores[best]).reset_index(drop=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Update and query the TF-IDF keyword index of the MD&A corpus")
+    parser.add_argument("--folder", default="keyword_index")
+    parser.add_argument("--corpus", default="mda_corpus")
+    parser.add_argument("--ticker")
+    parser.add_argument("--top", type=int, default=10, help="number of top terms per filing")
+    parser.add_argument("--drift", action="store_true", help="show how the ticker's language changes between filings")
+    parser.add_argument("--search", help="keywords to rank the filings by")
+    args = parser.parse_args()
+    serve_from_env()
+
+    index = KeywordIndex(args.folder)
+    index.update(get_corpus(args.corpus))
+    if args.search:
+        print(index.search(args.search, args.ticker).to_string())
+    elif args.drift:
+        if args.ticker is None:
+            parser.error("--drift needs --ticker")
+        print(index.term_drift(args.ticker, args.top).to_string())
+    else:
+        top = index.top_terms(args.ticker, args.top)
+        print(top.groupby(["ticker", "filing_date"], sort=False)["term"].agg(", ".join).to_string())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import argparse
+import hashlib
+import re
+
+# A heading is a short line without closing punctuation: "Item 2. Management's Discussion...", "Results of Operations",
+# "LIQUIDITY AND CAPITAL RESOURCES"
+_HEADING = re.compile(r"^((?i:item\s+\d+[a-z]?\.?.*)|[A-Z][^.!?:;]{2,80})$")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+# Table rows as rendered by edgartools are either pipe separated or columns padded with runs of spaces
+_TABLE_ROW = re.compile(r"\|.*\||\S\s{3,}\S")
+
+
+def _token_counter():
+    '''
+    :return: function counting tokens with the OpenAI tokenizer, or an estimate from the word count when tiktoken or
+    its encoding file is not available offline
+    '''
+    try:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return lambda text: int(len(text.split()) * 1.3) + 1
+
+
+def _is_heading(paragraph):
+    return "\n" not in paragraph and len(paragraph) <= 100 and bool(_HEADING.match(paragraph)) \
+        and not _TABLE_ROW.search(paragraph)
+
+
+def _is_table(paragraph):
+    lines = paragraph.splitlines()
+    return len(lines) > 1 and sum(1 for line in lines if _TABLE_ROW.search(line)) >= len(lines) / 2
+
+
+def _normalise(paragraph):
+    # Repeated boilerplate often differs only in line wrapping and case between filings
+    return re.sub(r"\s+", " ", paragraph).strip().lower()
+
+
+class MDAChunker:
+    '''
+    Splits MD&A text along its own structure instead of every 1000 characters.  Paragraphs are grouped under the
+    section heading they belong to and packed into chunks of at most max_tokens tokenizer tokens without overlap;
+    tables are kept whole where they fit and otherwise split between rows.  Every chunk starts with its section heading
+    so it still reads in context on its own.  Across a company's filings, paragraphs that repeat an earlier quarter
+    word for word are dropped, as they would only add duplicate vectors.
+    :param max_tokens: token budget of a chunk
+    :param min_dedup_tokens: paragraphs shorter than this are never treated as boilerplate
+    '''
+
+    def __init__(self, max_tokens=400, min_dedup_tokens=30):
+        self.max_tokens = max_tokens
+        self.min_dedup_tokens = min_dedup_tokens
+        self.count_tokens = _token_counter()
+
+    def _sections(self, text):
+        # Yield (heading, [paragraphs]) pairs in document order
+        heading = ""
+        paragraphs = []
+        for paragraph in _PARAGRAPH_BREAK.split(text):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if _is_heading(paragraph):
+                if paragraphs:
+                    yield heading, paragraphs
+                heading, paragraphs = paragraph, []
+            else:
+                paragraphs.append(paragraph)
+        if paragraphs:
+            yield heading, paragraphs
+
+    def _pieces(self, paragraph, budget):
+        # Break a paragraph that is over budget at row or sentence boundaries
+        if self.count_tokens(paragraph) <= budget:
+            return [paragraph]
+        parts = paragraph.splitlines() if _is_table(paragraph) else re.split(r"(?<=[.!?])\s+", paragraph)
+        pieces, current = [], ""
+        joiner = "\n" if _is_table(paragraph) else " "
+        for part in parts:
+            candidate = f"{current}{joiner}{part}" if current else part
+            if current and self.count_tokens(candidate) > budget:
+                pieces.append(current)
+                current = part
+            else:
+                current = candidate
+        if current:
+            pieces.append(current)
+        return pieces
+
+    def _chunks(self, text, seen=None):
+        chunks = []
+        for heading, paragraphs in self._sections(text):
+            prefix = f"{heading}\n\n" if heading else ""
+            budget = self.max_tokens - self.count_tokens(prefix)
+            current, current_tokens = [], 0
+            for paragraph in paragraphs:
+                tokens = self.count_tokens(paragraph)
+                if seen is not None and tokens >= self.min_dedup_tokens:
+                    key = hashlib.sha256(_normalise(paragraph).encode("utf-8")).hexdigest()
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                for piece in self._pieces(paragraph, budget):
+                    piece_tokens = self.count_tokens(piece)
+                    if current and current_tokens + piece_tokens > budget:
+                        chunks.append(prefix + "\n\n".join(current))
+                        current, current_tokens = [], 0
+                    current.append(piece)
+                    current_tokens += piece_tokens
+            if current:
+                chunks.append(prefix + "\n\n".join(current))
+        return chunks
+
+    def split_text(self, text):
+        '''
+        Chunk a single document, same interface as the langchain text splitters.
+        :param text: string MD&A text
+        :return: list of chunk strings
+        '''
+        return self._chunks(text)
+
+    def split_filings(self, texts):
+        '''
+        Chunk a company's filings together, dropping paragraphs already seen in an earlier one.
+        :param texts: list of MD&A texts of one company in filing date order
+        :return: list with the list of chunks of each filing
+        '''
+        seen = set()
+        return [self._chunks(text, seen) for text in texts]
+
+
+def main():
+    # Compare chunk count and index size of the character splitter with the structure-aware chunker
+    from langchain.text_splitter import CharacterTextSplitter
+
+    from storage import get_corpus
+
+    parser = argparse.ArgumentParser(description="Benchmark chunking of the MD&A corpus")
+    parser.add_argument("--corpus", default="mda_corpus")
+    parser.add_argument("--ticker", default=None)
+    parser.add_argument("--max-tokens", type=int, default=400)
+    parser.add_argument("--dim", type=int, default=1536, help="embedding size used to estimate the index size")
+    args = parser.parse_args()
+
+    by_ticker = {}
+    filings = get_corpus(args.corpus).read(args.ticker)
+    for ticker, text in zip(filings["ticker"], filings["text"]):
+        by_ticker.setdefault(ticker, []).append(text)
+
+    chunker = MDAChunker(max_tokens=args.max_tokens)
+    character_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    results = {
+        "CharacterTextSplitter(1000, 200)": [chunk for texts in by_ticker.values() for text in texts
+                                             for chunk in character_splitter.split_text(text)],
+        f"MDAChunker({args.max_tokens})": [chunk for texts in by_ticker.values()
+                                           for chunks in chunker.split_filings(texts) for chunk in chunks],
+    }
+
+    for name, chunks in results.items():
+        tokens = sum(chunker.count_tokens(chunk) for chunk in chunks)
+        index_mb = len(chunks) * args.dim * 4 / 1024 ** 2
+        print(f"{name}: {len(chunks)} chunks, {tokens} tokens embedded, ~{index_mb:.1f} MB of vectors")
+
+
+if __name__ == "__main__":
+    main()
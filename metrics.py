@@ -0,0 +1,224 @@
+import atexit
+import cProfile
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Everything is configured from the environment so any entry point (scripts, the app, the pipeline) can be measured
+# without code changes:
+#   EDGAR_LOG_JSON=1            write a JSON line for every timed span to stderr
+#   EDGAR_METRICS_FILE=path     write the metrics in Prometheus text format when the process exits
+#   EDGAR_METRICS_PORT=9100     serve the metrics at http://localhost:9100/metrics, from entry points calling
+#                               serve_from_env so processes spawned by a pool do not all try to bind the port
+#   EDGAR_PROFILE=folder        cProfile every profile() block into folder/<name>-<pid>.prof
+
+logger = logging.getLogger("edgar.metrics")
+# Spans are only logged through enable_json_logs, not through whatever handlers a library put on the root logger
+logger.propagate = False
+
+# cProfile can only run once at a time per process, Python 3.12 fails a second one outright
+_profile_lock = threading.Lock()
+_server = None
+_server_lock = threading.Lock()
+
+
+class Metrics:
+    '''
+    Thread-safe registry of counters and timers.  A timer keeps the count, total and maximum of its observations, which
+    is enough to see where the time goes without the cost of a histogram on hot paths.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timers = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Add to a counter.
+        :param name: metric name, e.g. 'cache_requests_total'
+        :param value: amount to add
+        :param labels: label values, e.g. result='hit'
+        '''
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        '''
+        Record one duration of a timer.
+        :param name: metric name, e.g. 'http_request_seconds'
+        :param seconds: duration to record
+        :param labels: label values, e.g. endpoint='sec'
+        '''
+        key = self._key(name, labels)
+        with self._lock:
+            count, total, peak = self._timers.get(key, (0, 0.0, 0.0))
+            self._timers[key] = (count + 1, total + seconds, max(peak, seconds))
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''
+        Time a block, counting it as an error when it raises.
+        :param name: metric name, e.g. 'inference_seconds'
+        :param labels: label values
+        '''
+        start_time = time.perf_counter()
+        status = "ok"
+        try:
+            yield
+        except BaseException:
+            status = "error"
+            self.inc(f"{name.removesuffix('_seconds')}_errors_total", **labels)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start_time
+            self.observe(name, elapsed, **labels)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(json.dumps({"ts": round(time.time(), 3), "event": name, "seconds": round(elapsed, 6),
+                                        "status": status, "thread": threading.current_thread().name, **labels}))
+
+    def snapshot(self):
+        '''
+        :return: copies of the counters and timers keyed on (name, labels)
+        '''
+        with self._lock:
+            return dict(self._counters), dict(self._timers)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def render_prometheus(self):
+        '''
+        :return: the metrics in the Prometheus text exposition format
+        '''
+        counters, timers = self.snapshot()
+
+        def labels_text(labels, **extra):
+            items = list(labels) + list(extra.items())
+            if not items:
+                return ""
+            return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE edgar_{name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"edgar_{name}{labels_text(labels)} {value}")
+        for name in sorted({name for name, _ in timers}):
+            lines.append(f"# TYPE edgar_{name} summary")
+            for (metric, labels), (count, total, peak) in sorted(timers.items()):
+                if metric == name:
+                    lines.append(f"edgar_{name}_count{labels_text(labels)} {count}")
+                    lines.append(f"edgar_{name}_sum{labels_text(labels)} {total:.6f}")
+                    lines.append(f"edgar_{name}_max{labels_text(labels)} {peak:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        '''
+        Write the metrics to a file, e.g. for the node exporter's textfile collector.
+        :param path: path of the .prom file
+        '''
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port=9100):
+        '''
+        Serve the metrics at /metrics from a daemon thread.
+        :param port: port to listen on
+        :return: the running server
+        '''
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        return server
+
+
+METRICS = Metrics()
+timer = METRICS.timer
+inc = METRICS.inc
+
+
+def enable_json_logs(stream=None):
+    '''
+    Write every timed span as a JSON line.
+    :param stream: stream to write to, stderr by default
+    '''
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+
+@contextmanager
+def profile(name):
+    '''
+    Profile a block with cProfile when EDGAR_PROFILE names a folder, otherwise do nothing.  Only one profiler can be
+    active in a process, so profiled blocks started from concurrent threads wait for each other and run one at a time.
+    cProfile only sees the thread it is started in; for the worker threads attach py-spy instead, e.g.
+    'py-spy record --subprocesses -o profile.svg -- python pipeline.py', the pools name their threads after the stage.
+    :param name: name of the profile file
+    '''
+    folder = os.environ.get("EDGAR_PROFILE")
+    if not folder:
+        yield
+        return
+    os.makedirs(folder, exist_ok=True)
+    with _profile_lock:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = os.path.join(folder, f"{name}-{os.getpid()}.prof")
+            profiler.dump_stats(path)
+            print(f"Profile of {name} saved to {path}, view it with 'python -m pstats {path}' or snakeviz")
+
+
+def serve_from_env():
+    '''
+    Serve the metrics on the port in EDGAR_METRICS_PORT, once per process.  Called by the entry points rather than on
+    import, so worker processes that import the modules do not compete for the port.
+    :return: the running server, None when EDGAR_METRICS_PORT is not set
+    '''
+    global _server
+    with _server_lock:
+        if _server is None and os.environ.get("EDGAR_METRICS_PORT"):
+            _server = METRICS.serve(int(os.environ["EDGAR_METRICS_PORT"]))
+        return _server
+
+
+if os.environ.get("EDGAR_LOG_JSON") == "1":
+    enable_json_logs()
+if os.environ.get("EDGAR_METRICS_FILE"):
+    atexit.register(METRICS.write_prometheus, os.environ["EDGAR_METRICS_FILE"])
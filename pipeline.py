@@ -0,0 +1,312 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import pandas as pd
+
+from ProjectEdgarGetData import DJIA_TICKERS, get_assets, get_mda_as_txt, get_prices
+from metrics import METRICS, enable_json_logs, profile, serve_from_env
+from storage import write_table
+
+
+class Stage:
+    '''
+    One step of the pipeline.
+    :param name: string name of the stage, also the name of its checkpoint
+    :param func: callable taking the run's parameters and a dictionary of the results of its dependencies
+    :param deps: names of the stages whose results it needs
+    '''
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+
+class Pipeline:
+    '''
+    Runs stages as a DAG.  A stage is started as soon as all of its dependencies are done, so independent stages run
+    concurrently, and every result is checkpointed so a failed or interrupted run resumes from the stages that did not
+    finish.  Checkpoints are keyed on the run's parameters and on the checkpoints of the stage's dependencies, so they
+    are ignored when the parameters change or when a dependency ran again, e.g. because it was forced.  They only serve
+    resuming: once every stage of a run has completed its checkpoints are removed, so running the same command again
+    does the work again.
+    :param stages: list of Stage
+    :param checkpoint_folder: string folder name of the checkpoints
+    '''
+
+    def __init__(self, stages, checkpoint_folder="checkpoints"):
+        self.stages = {stage.name: stage for stage in stages}
+        self.checkpoint_folder = checkpoint_folder
+        for stage in stages:
+            missing = set(stage.deps) - set(self.stages)
+            if missing:
+                raise ValueError(f"Stage {stage.name} depends on unknown stages {sorted(missing)}")
+        self._order()
+
+    def _order(self):
+        # Topological order of the stages, also rejects cycles
+        order, visiting, done = [], set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage {name} is part of a dependency cycle")
+            visiting.add(name)
+            for dep in self.stages[name].deps:
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def _selected(self, targets):
+        # The targets plus everything they depend on
+        if not targets:
+            return set(self.stages)
+        selected, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}")
+            if name not in selected:
+                selected.add(name)
+                todo.extend(self.stages[name].deps)
+        return selected
+
+    def _checkpoint_path(self, name):
+        return os.path.join(self.checkpoint_folder, f"{name}.pkl")
+
+    def _stage_key(self, key, name, tokens):
+        # Every checkpoint gets a token of its own, a stage's key changes whenever one of its dependencies ran again
+        deps = {dep: tokens[dep] for dep in self.stages[name].deps}
+        return hashlib.sha256(json.dumps([key, deps], sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _load_checkpoint(self, name, key):
+        path = self._checkpoint_path(name)
+        if not os.path.exists(path):
+            return False, None, None
+        with open(path, "rb") as f:
+            checkpoint = pickle.load(f)
+        if checkpoint["key"] != key:
+            return False, None, None
+        return True, checkpoint["result"], checkpoint["token"]
+
+    def _save_checkpoint(self, name, key, result, elapsed):
+        os.makedirs(self.checkpoint_folder, exist_ok=True)
+        path = self._checkpoint_path(name)
+        tmp_path = f"{path}.tmp"
+        token = uuid.uuid4().hex
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"key": key, "token": token, "result": result, "elapsed": elapsed, "saved": time.time()}, f)
+        os.replace(tmp_path, path)
+        return token
+
+    def run(self, params, targets=None, force=(), max_workers=3):
+        '''
+        Run the selected stages, reusing the checkpoints of stages that already completed with the same parameters.
+        :param params: dictionary of the run's parameters, passed to every stage and used to key the checkpoints
+        :param targets: names of the stages to run, their dependencies are included, all stages when None
+        :param force: names of stages to re-run even if they have a checkpoint, the stages depending on them re-run too
+        :param max_workers: number of stages run at once
+        :return: dictionary of stage name to result
+        '''
+        key = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        selected = self._selected(targets)
+        results, timings, tokens = {}, {}, {}
+        start_time = time.time()
+
+        # Stages with a valid checkpoint are done before anything is started, in dependency order so a stage whose
+        # dependency has to run again is run again as well
+        for name in self._order():
+            if name in selected and name not in force and all(dep in tokens for dep in self.stages[name].deps):
+                found, result, token = self._load_checkpoint(name, self._stage_key(key, name, tokens))
+                if found:
+                    results[name] = result
+                    tokens[name] = token
+                    timings[name] = "checkpoint"
+                    print(f"[{name}] resumed from checkpoint")
+
+        def execute(stage):
+            # With --profile the stages take turns, the wait for the profiler is not part of their time
+            with profile(stage.name):
+                print(f"[{stage.name}] started")
+                stage_start = time.time()
+                with METRICS.timer("stage_seconds", stage=stage.name):
+                    result = stage.func(params, {dep: results[dep] for dep in stage.deps})
+                elapsed = time.time() - stage_start
+            token = self._save_checkpoint(stage.name, self._stage_key(key, stage.name, tokens), result, elapsed)
+            print(f"[{stage.name}] finished in {elapsed:.2f}s")
+            return result, elapsed, token
+
+        pending = {name for name in selected if name not in results}
+        failed = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stage") as pool:
+            while pending or running:
+                # Start every stage whose dependencies have all completed
+                for name in sorted(pending):
+                    stage = self.stages[name]
+                    if any(dep in failed for dep in stage.deps):
+                        failed[name] = "dependency failed"
+                        pending.discard(name)
+                        print(f"[{name}] skipped, a dependency failed")
+                    elif all(dep in results for dep in stage.deps):
+                        running[pool.submit(execute, stage)] = name
+                        pending.discard(name)
+
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name], timings[name], tokens[name] = future.result()
+                    except Exception as e:
+                        failed[name] = e
+                        print(f"[{name}] failed: {e}")
+
+        print(f"Pipeline finished in {time.time() - start_time:.2f}s")
+        for name in self._order():
+            if name in timings:
+                timing = timings[name]
+                print(f"  {name}: {timing if isinstance(timing, str) else f'{timing:.2f}s'}")
+            elif name in failed:
+                print(f"  {name}: failed")
+        if failed:
+            raise RuntimeError(f"Stages failed: {', '.join(sorted(failed))}, completed stages are checkpointed")
+
+        for name in selected:
+            if os.path.exists(self._checkpoint_path(name)):
+                os.remove(self._checkpoint_path(name))
+        return results
+
+
+def _assets_stage(params, inputs):
+    final_assets, ticker_dates = get_assets(params["tickers"], params["start_year"],
+                                            max_workers=params["max_workers"])
+    # Only keep filings inside the requested date range, the stage fetches whole years
+    end = params["end"]
+    final_assets = final_assets[final_assets["filed"].between(pd.Timestamp(params["start"]), pd.Timestamp(end))]
+    ticker_dates = {ticker: [date for date in dates if params["start"] <= date <= end]
+                    for ticker, dates in ticker_dates.items()}
+    return final_assets, ticker_dates
+
+
+def _prices_stage(params, inputs):
+    _, ticker_dates = inputs["assets"]
+    return get_prices(ticker_dates)
+
+
+def _mda_stage(params, inputs):
+    return get_mda_as_txt(params["tickers"], params["start_year"], params["output_folder"], params["max_workers"])
+
+
+def _sentiment_stage(params, inputs):
+    # Imported here so runs without the sentiment stage do not pay for loading torch
+    from sentiment_analysis import get_sentiment_analysis
+
+    frames = [get_sentiment_analysis(ticker) for ticker in params["tickers"]]
+    results = pd.concat(frames).rename_axis("accession_no").reset_index()
+    write_table(results, "sentiment_analysis.parquet")
+    return results
+
+
+def _index_stage(params, inputs):
+    # Imported here so runs without the indexing stage do not pay for loading the embedding backends
+    from embedding_cache import get_embeddings
+    from mda_chunker import MDAChunker
+    from storage import get_corpus
+    from vector_index import update_vector_store
+
+    text_splitter = MDAChunker(max_tokens=400)
+    embeddings = get_embeddings()
+    return {ticker: update_vector_store(get_corpus(), params["vector_store_folder"], ticker,
+                                        params["start_year"], text_splitter, embeddings)
+            for ticker in params["tickers"]}
+
+
+def _keywords_stage(params, inputs):
+    # Adds the MD&A the mda stage appended to the corpus to the TF-IDF index
+    from keyword_index import KeywordIndex
+
+    return KeywordIndex().update()
+
+
+STAGES = [
+    Stage("assets", _assets_stage),
+    Stage("prices", _prices_stage, deps=("assets",)),
+    Stage("mda", _mda_stage),
+    Stage("sentiment", _sentiment_stage, deps=("mda",)),
+    Stage("index", _index_stage, deps=("mda",)),
+    Stage("keywords", _keywords_stage, deps=("mda",)),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the EDGAR data pipeline")
+    parser.add_argument("--tickers", nargs="*", default=DJIA_TICKERS,
+                        help="tickers to process, defaults to the current and legacy DJIA constituents")
+    parser.add_argument("--tickers-file", help="file with one ticker per line, used instead of --tickers")
+    parser.add_argument("--start", default="2016-01-01", help="first filing date, YYYY-MM-DD")
+    parser.add_argument("--end", help="last filing date, YYYY-MM-DD, defaults to today")
+    parser.add_argument("--stages", nargs="*", choices=[stage.name for stage in STAGES],
+                        help="stages to run, their dependencies are included, all stages by default")
+    parser.add_argument("--force", nargs="*", default=[], choices=[stage.name for stage in STAGES],
+                        help="stages to re-run even if they have a checkpoint, the stages depending on them re-run too")
+    parser.add_argument("--output-folder", default="mda_texts", help="folder of the MD&A sync manifest, the texts are "
+                        "kept in mda_corpus")
+    parser.add_argument("--vector-store-folder", default="vector_store")
+    parser.add_argument("--checkpoint-folder", default="checkpoints")
+    parser.add_argument("--max-workers", type=int, default=4, help="tickers fetched concurrently by each stage")
+    parser.add_argument("--metrics-file", default="pipeline_metrics.prom",
+                        help="where to write the run's metrics in Prometheus text format")
+    parser.add_argument("--log-json", action="store_true", help="log every timed span as a JSON line to stderr")
+    parser.add_argument("--profile", metavar="FOLDER", help="cProfile each stage into FOLDER, stages then run one at "
+                        "a time")
+    args = parser.parse_args()
+
+    serve_from_env()
+
+    if args.log_json:
+        enable_json_logs()
+    if args.profile:
+        os.environ["EDGAR_PROFILE"] = args.profile
+
+    tickers = args.tickers
+    if args.tickers_file:
+        with open(args.tickers_file, encoding="utf-8") as f:
+            tickers = [line.strip() for line in f if line.strip()]
+
+    # Set identity to your name and email, not a credential but for record keeping
+    from edgar import set_identity
+    set_identity("Mitchell Hornsby hornsby.m@northeastern.edu")
+
+    # Every parameter is concrete, so a run on another day does not resume the checkpoints of today's failed run
+    params = {
+        "tickers": [ticker.upper() for ticker in tickers],
+        "start": args.start,
+        "start_year": pd.Timestamp(args.start).year,
+        "end": args.end or pd.Timestamp.today().strftime("%Y-%m-%d"),
+        "output_folder": args.output_folder,
+        "vector_store_folder": args.vector_store_folder,
+        "max_workers": args.max_workers,
+    }
+    try:
+        Pipeline(STAGES, args.checkpoint_folder).run(params, targets=args.stages, force=args.force)
+    finally:
+        METRICS.write_prometheus(args.metrics_file)
+        print(f"Metrics saved to {args.metrics_file}")
+
+
+if __name__ == "__main__":
+    main()
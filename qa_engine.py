@@ -0,0 +1,297 @@
+import asyncio
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGenerationChunk
+
+from metrics import METRICS
+from vector_index import ticker_fetch_k
+
+# Answers are reused for questions whose embeddings are at least this similar
+SIMILARITY_THRESHOLD = 0.95
+
+
+class StubChatModel(SimpleChatModel):
+    '''
+    Offline chat model for tests and demos.  It answers with the first sentences of the retrieved context and streams
+    them word by word, so the whole question answering path runs without an API key or network.
+    '''
+
+    sentences: int = 3
+
+    @property
+    def _llm_type(self):
+        return "stub"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        context = messages[-1].content.split("Context:", 1)[-1].split("Question:", 1)[0]
+        sentences = [sentence.strip() for sentence in context.replace("\n", " ").split(". ") if sentence.strip()]
+        if not sentences:
+            return "The filings do not say."
+        return "According to the filings: " + ". ".join(sentences[:self.sentences]).rstrip(".") + "."
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        for i, word in enumerate(self._call(messages, stop, run_manager, **kwargs).split(" ")):
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else f" {word}"))
+            if run_manager is not None:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+
+def get_llm(backend=None):
+    '''
+    Chat model used to answer questions.
+    :param backend: 'openai' or 'stub', defaults to the QA_LLM environment variable or openai
+    :return: langchain chat model that supports streaming
+    '''
+    backend = backend or os.environ.get("QA_LLM", "openai")
+    if backend == "stub":
+        return StubChatModel()
+    if backend == "openai":
+        # The stub only quotes the filings, so it is never used in place of OpenAI without being asked for
+        if not os.environ.get("OPENAI_API_KEY"):
+            raise RuntimeError("OPENAI_API_KEY is not set, set it or set QA_LLM=stub to answer without OpenAI")
+        from langchain_community.chat_models import ChatOpenAI
+        return ChatOpenAI(temperature=0.5, model="gpt-3.5-turbo", streaming=True)
+    raise ValueError(f"Unknown LLM backend {backend}")
+
+
+class LRUCache:
+    '''
+    Small thread-safe least recently used cache.
+    :param max_entries: number of entries kept
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SemanticCache:
+    '''
+    Answers keyed on a namespace, such as the ticker, and the embedded question.  A question hits when its embedding is
+    within the similarity threshold of one asked before in the same namespace, so rewordings of a common question are
+    answered from the cache.  Namespaces are dropped least recently used first, which also clears the ones of an index
+    that has since grown.
+    :param threshold: minimum cosine similarity for a hit
+    :param max_entries: answers kept per namespace, the oldest are dropped first
+    :param max_namespaces: namespaces kept
+    '''
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, max_entries=512, max_namespaces=64):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_namespaces = max_namespaces
+        # Namespace to (normalised question vectors, [(answer, sources)])
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalise(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def get(self, namespace, vector):
+        '''
+        :param namespace: string namespace, e.g. the ticker
+        :param vector: embedding of the question
+        :return: (answer, sources) of the most similar earlier question, or None
+        '''
+        with self._lock:
+            if namespace not in self._entries:
+                return None
+            self._entries.move_to_end(namespace)
+            vectors, answers = self._entries[namespace]
+            similarities = vectors @ self._normalise(vector)
+            best = int(similarities.argmax())
+            if similarities[best] < self.threshold:
+                return None
+            return answers[best]
+
+    def put(self, namespace, vector, answer, sources):
+        with self._lock:
+            vector = self._normalise(vector)[None, :]
+            vectors, answers = self._entries.get(namespace, (None, []))
+            vectors = vector if vectors is None else np.vstack([vectors, vector])[-self.max_entries:]
+            self._entries[namespace] = vectors, (answers + [(answer, sources)])[-self.max_entries:]
+            self._entries.move_to_end(namespace)
+            while len(self._entries) > self.max_namespaces:
+                self._entries.popitem(last=False)
+
+
+class AnswerEngine:
+    '''
+    Question answering over a ticker's MD&A chunks.  Answers are looked up in a semantic cache first and retrieved
+    chunks in a retrieval cache, so a repeated question costs one cached embedding lookup.  Retrieval uses the question
+    as asked and the recent turns go into the answer prompt instead of a separate LLM call to condense the question.
+    Tokens are streamed as they are generated.  With a keyword index the vector search is narrowed to the filings
+    whose TF-IDF weight for the question's terms is highest.
+    :param vector_store: FAISS vector store holding the chunks
+    :param embeddings: langchain embeddings, the same ones the store was built with
+    :param llm: langchain chat model, see get_llm
+    :param system_prompt: instructions put in front of every prompt
+    :param k: number of chunks retrieved per question
+    :param history_turns: number of earlier question and answer pairs included in the prompt
+    :param semantic_cache: SemanticCache, can be shared between engines
+    :param retrieval_cache: LRUCache of retrieved chunks, can be shared between engines
+    :param keyword_index: optional KeywordIndex of the same filings used as a lexical pre-filter
+    :param prefilter_filings: number of filings the keyword index narrows the search to
+    '''
+
+    def __init__(self, vector_store, embeddings, llm, system_prompt="", k=4, history_turns=3, semantic_cache=None,
+                 retrieval_cache=None, keyword_index=None, prefilter_filings=4):
+        self.vector_store = vector_store
+        self.embeddings = embeddings
+        self.llm = llm
+        self.system_prompt = system_prompt
+        self.k = k
+        self.history_turns = history_turns
+        self.semantic_cache = semantic_cache if semantic_cache is not None else SemanticCache()
+        self.retrieval_cache = retrieval_cache if retrieval_cache is not None else LRUCache()
+        self.keyword_index = keyword_index
+        self.prefilter_filings = prefilter_filings
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def _namespace(self, ticker):
+        # Cached entries are tied to the size of the index so they are not served once new filings are added
+        return f"{ticker}@{len(self.vector_store.index_to_docstore_id)}"
+
+    def _retrieve(self, ticker, question, vector):
+        # Chunks for the question, searched by the already computed embedding
+        key = (self._namespace(ticker), hashlib.sha256(question.strip().lower().encode("utf-8")).hexdigest(), self.k)
+        docs = self.retrieval_cache.get(key)
+        METRICS.inc("qa_retrieval_cache_total", result="miss" if docs is None else "hit")
+        if docs is None:
+            docs = []
+            filing_dates = self._prefilter(ticker, question)
+            if filing_dates:
+                fetch_k = ticker_fetch_k(self.vector_store, ticker, self.k, filing_dates)
+                docs = self.vector_store.similarity_search_by_vector(
+                    vector, k=self.k, filter={"ticker": ticker, "filing_date": filing_dates}, fetch_k=fetch_k)
+            # Without matching terms, or when the matching filings are not all indexed, search every filing
+            if len(docs) < self.k:
+                fetch_k = ticker_fetch_k(self.vector_store, ticker, self.k)
+                docs = self.vector_store.similarity_search_by_vector(vector, k=self.k, filter={"ticker": ticker},
+                                                                     fetch_k=fetch_k)
+            self.retrieval_cache.put(key, docs)
+        return docs
+
+    def _prefilter(self, ticker, question):
+        # Filing dates of the filings that use the question's terms the most
+        if self.keyword_index is None:
+            return None
+        filings = self.keyword_index.search(question, ticker=ticker, k=self.prefilter_filings)
+        METRICS.inc("qa_prefilter_total", result="narrowed" if len(filings) else "no_match")
+        return filings["filing_date"].dt.strftime("%Y-%m-%d").tolist() or None
+
+    def _messages(self, question, docs, history):
+        context = "\n\n".join(doc.page_content for doc in docs)
+        messages = [SystemMessage(content=self.system_prompt)] if self.system_prompt else []
+        for asked, answered in history[-self.history_turns:] if self.history_turns else []:
+            messages.extend([HumanMessage(content=asked), AIMessage(content=answered)])
+        messages.append(HumanMessage(content=f"Answer using the context from the company's filings.\n\n"
+                                             f"Context:\n{context}\n\nQuestion: {question}"))
+        return messages
+
+    async def astream(self, ticker, question, history=()):
+        '''
+        Answer a question, yielding the answer as it is generated.  A cached answer is yielded in one piece.
+        :param ticker: string stock ticker identifier
+        :param question: question as the user asked it
+        :param history: list of earlier (question, answer) pairs
+        :return: async iterator of answer text pieces
+        '''
+        start_time = time.perf_counter()
+        vector = await asyncio.to_thread(self.embeddings.embed_query, question)
+
+        # Follow-up questions depend on the conversation so only standalone questions are served from the cache
+        cached = self.semantic_cache.get(self._namespace(ticker), vector) if not history else None
+        METRICS.inc("qa_answer_cache_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            METRICS.observe("qa_seconds", time.perf_counter() - start_time, result="cached")
+            yield cached[0]
+            return
+
+        docs = await asyncio.to_thread(self._retrieve, ticker, question, vector)
+        pieces = []
+        first_token = None
+        async for chunk in self.llm.astream(self._messages(question, docs, list(history))):
+            if first_token is None:
+                first_token = time.perf_counter() - start_time
+                METRICS.observe("qa_first_token_seconds", first_token)
+            pieces.append(chunk.content)
+            yield chunk.content
+
+        answer = "".join(pieces)
+        if not history:
+            self.semantic_cache.put(self._namespace(ticker), vector, answer, [doc.metadata for doc in docs])
+        METRICS.observe("qa_seconds", time.perf_counter() - start_time, result="generated")
+
+    async def aanswer(self, ticker, question, history=()):
+        '''
+        :return: the whole answer to a question, see astream
+        '''
+        return "".join([piece async for piece in self.astream(ticker, question, history)])
+
+    def _event_loop(self):
+        # One event loop per engine, run on a daemon thread, drives the async pipeline for synchronous callers
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="qa-loop", daemon=True).start()
+            return self._loop
+
+    def stream(self, ticker, question, history=()):
+        '''
+        Synchronous version of astream for callers without an event loop, such as Streamlit scripts.
+        :return: iterator of answer text pieces
+        '''
+        pieces = queue.Queue()
+        done = object()
+
+        async def produce():
+            try:
+                async for piece in self.astream(ticker, question, history):
+                    pieces.put(piece)
+            except Exception as e:
+                pieces.put(e)
+            finally:
+                pieces.put(done)
+
+        asyncio.run_coroutine_threadsafe(produce(), self._event_loop())
+        while True:
+            piece = pieces.get()
+            if piece is done:
+                return
+            if isinstance(piece, Exception):
+                raise piece
+            yield piece
+
+    def answer(self, ticker, question, history=()):
+        '''
+        :return: the whole answer to a question, see astream
+        '''
+        return "".join(self.stream(ticker, question, history))
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from metrics import METRICS
+
+# Time to live for things that change when a company files something new
+SUBMISSIONS_TTL = 24 * 60 * 60
+FACTS_TTL = 24 * 60 * 60
+PRICES_TTL = 24 * 60 * 60
+
+# A response that had nothing in it, such as a 10-Q whose Item 2 could not be located, is tried again after this long
+# in case the filing or the parser is fixed
+MISSING_TTL = 24 * 60 * 60
+
+
+class ResponseCache:
+    '''
+    Persistent on-disk cache for EDGAR and Yahoo responses.  Payloads are stored content-addressed by their sha256 so
+    identical responses are only kept once, and a small SQLite index maps each key (a URL, CIK or accession number) to
+    its payload along with an optional expiry time.  Entries without a time to live never expire, which is what we want
+    for filings as they are immutable once accepted.  When the total size goes over max_bytes the least recently used
+    entries are evicted.
+    :param folder: directory to keep the index and payloads in
+    :param max_bytes: size cap for all payloads together
+    '''
+
+    def __init__(self, folder=".edgar_cache", max_bytes=2 * 1024 ** 3):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(folder, "objects"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(folder, "index.db"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, digest TEXT NOT NULL, size INTEGER NOT NULL, "
+            "accessed REAL NOT NULL, expires REAL)"
+        )
+        self._db.commit()
+
+    def _object_path(self, digest):
+        return os.path.join(self.folder, "objects", digest[:2], digest)
+
+    def get(self, key):
+        '''
+        Look up a key.
+        :param key: string cache key
+        :return: the cached bytes or None if the key is missing or expired
+        '''
+        data = self._read(key)
+        # Keys are namespaced as 'kind:...', which is few enough values to label by
+        METRICS.inc("cache_requests_total", kind=key.split(":", 1)[0], result="miss" if data is None else "hit")
+        return data
+
+    def _read(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT digest, expires FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            digest, expires = row
+            if expires is not None and expires < time.time():
+                self._delete(key, digest)
+                return None
+            try:
+                with open(self._object_path(digest), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self._delete(key, digest)
+                return None
+            self._db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            return data
+
+    def put(self, key, data, ttl=None):
+        '''
+        Store bytes under a key.
+        :param key: string cache key
+        :param data: bytes to store
+        :param ttl: seconds until the entry expires, None to keep it until it is evicted
+        '''
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            expires = time.time() + ttl if ttl is not None else None
+            old = self._db.execute("SELECT digest FROM entries WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, digest, size, accessed, expires) VALUES (?, ?, ?, ?, ?)",
+                (key, digest, len(data), time.time(), expires),
+            )
+            if old is not None and old[0] != digest:
+                self._remove_unreferenced(old[0])
+            self._db.commit()
+            self._evict()
+
+    def cached(self, key, producer, ttl=None, missing_ttl=MISSING_TTL):
+        '''
+        Return the cached value for key, calling producer and storing its pickled result on a miss.
+        :param key: string cache key
+        :param producer: callable with no arguments that fetches the value
+        :param ttl: seconds until the entry expires, None to keep it until it is evicted
+        :param missing_ttl: seconds until a None result expires, so it is produced again later
+        :return: the cached or freshly produced value
+        '''
+        data = self.get(key)
+        if data is not None:
+            return pickle.loads(data)
+        value = producer()
+        self.put(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ttl=missing_ttl if value is None else ttl)
+        return value
+
+    def total_bytes(self):
+        '''
+        :return: size of all distinct payloads currently in the cache
+        '''
+        with self._lock:
+            row = self._db.execute("SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM entries)").fetchone()
+        return row[0] or 0
+
+    def _delete(self, key, digest):
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._remove_unreferenced(digest)
+        self._db.commit()
+
+    def _remove_unreferenced(self, digest):
+        # Payloads are shared between keys so only remove the file once nothing points at it
+        if self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+            try:
+                os.remove(self._object_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        # Drop least recently used entries until the distinct payloads fit under the size cap
+        total = self._db.execute("SELECT SUM(size) FROM (SELECT DISTINCT digest, size FROM entries)").fetchone()[0] or 0
+        if total <= self.max_bytes:
+            return
+        for key, digest, size in self._db.execute(
+                "SELECT key, digest, size FROM entries ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            if self._db.execute("SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)).fetchone() is None:
+                try:
+                    os.remove(self._object_path(digest))
+                except FileNotFoundError:
+                    pass
+                total -= size
+            if total <= self.max_bytes:
+                break
+        self._db.commit()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    '''
+    Shared cache for the whole process, created on first use so importing a module does not create the folder or open
+    the database.  The location and size cap can be changed through the environment.
+    :return: the ResponseCache
+    '''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache(
+                folder=os.environ.get("EDGAR_CACHE_DIR", ".edgar_cache"),
+                max_bytes=int(os.environ.get("EDGAR_CACHE_MAX_MB", "2048")) * 1024 ** 2,
+            )
+    return _cache
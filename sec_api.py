@@ -1,71 +1,182 @@
+import argparse
 import json
 import requests
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 
-def download_10q_reports(ticker):
-    # Load company tickers from the JSON file
-    with open('company_tickers.json') as f:
-        company_data = json.load(f)
+from fetch_utils import SEC_LIMITER, with_retries
+from metrics import METRICS, serve_from_env
+from response_cache import SUBMISSIONS_TTL, get_cache
+from ticker_lookup import ticker_to_cik
 
-    # Find the company by ticker
-    company_info = next((info for info in company_data.values() if info['ticker'] == ticker), None)
+# Base URLs can be pointed at a local stub server for testing
+SEC_DATA_URL = os.environ.get("SEC_DATA_URL", "https://data.sec.gov")
+SEC_ARCHIVES_URL = os.environ.get("SEC_ARCHIVES_URL", "https://www.sec.gov/Archives")
 
-    if not company_info:
-        print(f"No data found for ticker: {ticker}")
-        return
+# SEC requires a User-Agent naming who is making the requests, e.g. "Jane Doe jane@example.com"
+SEC_USER_AGENT = os.environ.get("SEC_USER_AGENT", "Your Name AdminContact@yourdomain.com")
 
-    cik = company_info['cik_str']
-    base_url = "https://data.sec.gov/api/xbrl/"
-    headers = {
-        'User-Agent': 'Your Name AdminContact@yourdomain.com',  # Change this line
-        'Accept-Encoding': 'gzip, deflate'
-    }
+# Number of documents downloaded at once, the shared limiter still caps the request rate
+MAX_DOWNLOADS = 4
 
-    # Fetch 10-Q filings
-    filings_url = f"https://data.sec.gov/submissions/CIK{str(cik).zfill(10)}.json"
-    response = requests.get(filings_url, headers=headers)
+_session = None
+_session_lock = threading.Lock()
 
+def get_session():
+    # One pooled session per process so connections to sec.gov are reused between requests
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_DOWNLOADS * 2)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            _session.headers.update({
+                'User-Agent': SEC_USER_AGENT,
+                'Accept-Encoding': 'gzip, deflate'
+            })
+    return _session
+
+def _get(url, **kwargs):
+    with METRICS.timer("http_request_seconds", endpoint="sec"):
+        response = get_session().get(url, timeout=30, **kwargs)
+    METRICS.inc("http_responses_total", endpoint="sec", status=response.status_code)
+    # with_retries tries throttled and server error responses again, anything else is returned to the caller
+    return response
+
+def cached_get(url, ttl=None):
+    # Serve the response body from the on-disk cache, only going to the network on a miss
+    key = f"url:{url}"
+    content = get_cache().get(key)
+    if content is not None:
+        return content
+
+    response = with_retries(_get, url, limiter=SEC_LIMITER)
     if response.status_code != 200:
-        print(f"Failed to fetch filings for CIK {cik}: {response.text}")
-        return
-
-    filings_data = response.json()
-    
-    # Extract recent filings
-    recent_filings = filings_data['filings']['recent']
-    
-    # Create a list of filings with relevant data
-    reports = []
-    for i in range(len(recent_filings['form'])):
-        if recent_filings['form'][i] == '10-Q':
-            print(recent_filings.keys())
-            report = {
-                'form': recent_filings['form'][i],
-                'filingDate': recent_filings['filingDate'][i],
-                'accessionNumber': recent_filings['accessionNumber'][i],
-                'fileName': recent_filings['primaryDocument'][i]
-            }
-            reports.append(report)
-
-    # Download up to 10 reports
-    for report in reports[:10]:
-        filing_date = report['filingDate']
-        accession_number = report['accessionNumber']
-        report_url = f"https://www.sec.gov/Archives/edgar/data/{cik}/{accession_number.replace('-', '')}/{report['fileName']}"
-
-        # Define the download path
-        download_path = os.path.join(os.getcwd(), f"{ticker}_10Q_{filing_date}.txt")
-
-        print(f"Downloading: {report_url} to {download_path}")
-        report_response = requests.get(report_url, headers=headers)
-
-        if report_response.status_code == 200:
-            with open(download_path, 'wb') as f:
-                f.write(report_response.content)
-            print(f"Downloaded: {download_path}")
-        else:
-            print(f"Failed to download report: {report_response.text}")
+        print(f"Failed to fetch {url}: {response.text}")
+        return None
+
+    get_cache().put(key, response.content, ttl=ttl)
+    return response.content
+
+def _10q_reports(filings):
+    # Pick the 10-Q rows out of a block of the submissions index
+    return [{
+        'form': filings['form'][i],
+        'filingDate': filings['filingDate'][i],
+        'accessionNumber': filings['accessionNumber'][i],
+        'fileName': filings['primaryDocument'][i]
+    } for i in range(len(filings['form'])) if filings['form'][i] == '10-Q']
+
+def get_10q_filings(cik, limit=None):
+    # Fetch the submissions index, whose recent block holds about the last 1000 filings of any form
+    content = cached_get(f"{SEC_DATA_URL}/submissions/CIK{str(cik).zfill(10)}.json", ttl=SUBMISSIONS_TTL)
+    if content is None:
+        print(f"Failed to fetch filings for CIK {cik}")
+        return []
+
+    filings_data = json.loads(content)
+    reports = _10q_reports(filings_data['filings']['recent'])
+
+    # The older pages listed under filings/files are only fetched while fewer than limit 10-Qs were found, newest
+    # page first
+    for page in filings_data['filings'].get('files', []):
+        if limit is not None and len(reports) >= limit:
+            break
+        page_content = cached_get(f"{SEC_DATA_URL}/submissions/{page['name']}", ttl=SUBMISSIONS_TTL)
+        if page_content is not None:
+            reports.extend(_10q_reports(json.loads(page_content)))
+
+    # Newest first, up to limit of them
+    reports.sort(key=lambda report: report['filingDate'], reverse=True)
+
+    return reports[:limit]
+
+def download_report(url, download_path):
+    # Stream the document to a temporary file in chunks and only move it into place once it is complete
+    tmp_path = f"{download_path}.part"
+
+    def stream():
+        with METRICS.timer("http_request_seconds", endpoint="sec_archives"), \
+                get_session().get(url, stream=True, timeout=60) as response:
+            METRICS.inc("http_responses_total", endpoint="sec_archives", status=response.status_code)
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            if response.status_code != 200:
+                return False
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+                    METRICS.inc("http_bytes_total", len(chunk), endpoint="sec_archives")
+        os.replace(tmp_path, download_path)
+        return True
+
+    try:
+        return with_retries(stream, limiter=SEC_LIMITER)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def download_10q_reports(tickers, output_folder=".", limit=10, max_workers=MAX_DOWNLOADS):
+    # Accept a single ticker or a list of them
+    if isinstance(tickers, str):
+        tickers = [tickers]
+
+    os.makedirs(output_folder, exist_ok=True)
+
+    jobs = []
+    for ticker in tickers:
+        # Find the company by ticker in the indexed company_tickers.json
+        cik = ticker_to_cik(ticker)
+
+        if cik is None:
+            print(f"No data found for ticker: {ticker}")
+            continue
+
+        # Download up to limit reports per ticker, None for all of them
+        for report in get_10q_filings(cik, limit):
+            accession_number = report['accessionNumber']
+            report_url = (f"{SEC_ARCHIVES_URL}/edgar/data/{cik}/{accession_number.replace('-', '')}/"
+                          f"{report['fileName']}")
+
+            # Define the download path, the accession number makes it unique per filing
+            download_path = os.path.join(output_folder,
+                                         f"{ticker.upper()}_10Q_{report['filingDate']}_{accession_number}.txt")
+
+            # Skip filings that are already on disk from an earlier run
+            if os.path.exists(download_path):
+                continue
+            jobs.append((report_url, download_path))
+
+    print(f"Downloading {len(jobs)} reports")
+    downloaded = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(download_report, url, path): (url, path) for url, path in jobs}
+        for future in as_completed(futures):
+            url, path = futures[future]
+            try:
+                if future.result():
+                    downloaded.append(path)
+                    print(f"Downloaded: {path}")
+                else:
+                    print(f"Failed to download report: {url}")
+            except Exception as e:
+                print(f"Failed to download report: {url} ({e})")
+
+    return downloaded
 
 if __name__ == "__main__":
-    ticker_input = input("Enter the ticker symbol (e.g., AAPL): ").strip()
-    download_10q_reports(ticker_input)
+    parser = argparse.ArgumentParser(description="Download the 10-Q documents of tickers from SEC EDGAR")
+    parser.add_argument("tickers", nargs="*", help="ticker symbols, asked for when none are given")
+    parser.add_argument("--limit", type=lambda value: None if value == "all" else int(value), default=10,
+                        help="newest 10-Qs to download per ticker, 'all' for every one")
+    parser.add_argument("--output-folder", default=".")
+    args = parser.parse_args()
+    serve_from_env()
+
+    # Tickers can be given on the command line or entered, separated by commas or spaces
+    ticker_input = " ".join(args.tickers) or input("Enter the ticker symbols (e.g., AAPL, MSFT): ")
+    download_10q_reports([ticker.strip() for ticker in ticker_input.replace(",", " ").split()],
+                         output_folder=args.output_folder, limit=args.limit)
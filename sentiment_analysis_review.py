@@ -1,6 +1,14 @@
+import os
+
 import pandas as pd
 
-sen_ana = pd.read_csv('sentiment_analysis.csv')
+from storage import read_table
+
+# Prefer the Parquet output, older runs only left a csv behind
+if os.path.exists('sentiment_analysis.parquet'):
+    sen_ana = read_table('sentiment_analysis.parquet', columns=['Sentiment'])
+else:
+    sen_ana = pd.read_csv('sentiment_analysis.csv')
 
 
-print(sen_ana['Sentiment'].value_counts(normalize=True) * 100)
\ No newline at end of file
+print(sen_ana['Sentiment'].value_counts(normalize=True) * 100)
@@ -0,0 +1,227 @@
+import hashlib
+import mmap
+import os
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import fcntl
+except ImportError:  # Windows locks a byte range of the file instead
+    fcntl = None
+    import msvcrt
+
+# Columns stored as real dates rather than strings wherever they appear
+DATE_COLUMNS = ("Date", "filed", "end", "start", "filing_date")
+
+
+@contextmanager
+def file_lock(path):
+    '''
+    Exclusive lock shared between processes, e.g. the app and the pipeline writing to the same store.  The lock is
+    held on a small file next to the data it protects.  It does not exclude threads of the same process from each
+    other, callers keep their own threading lock for that.
+    :param path: path of the lock file, created if missing
+    '''
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_table(df, path):
+    '''
+    Save a pipeline output as Parquet with typed date columns.  The file is written next to its final name and then
+    moved into place so readers never see a partial file.
+    :param df: data frame to save
+    :param path: path of the Parquet file, e.g. 'assets_data.parquet'
+    :return: the path written
+    '''
+    df = df.copy()
+    for column in DATE_COLUMNS:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column])
+
+    tmp_path = f"{path}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_table(path, columns=None, filters=None):
+    '''
+    Load a pipeline output, reading only the requested columns and row groups through a memory map.
+    :param path: path of the Parquet file
+    :param columns: optional list of columns to read
+    :param filters: optional pyarrow filters, e.g. [('Ticker', '==', 'AAPL')]
+    :return: data frame
+    '''
+    return pq.read_table(path, columns=columns, filters=filters, memory_map=True).to_pandas()
+
+
+class MdaCorpus:
+    '''
+    Single append-only store for the MD&A texts.  All texts are concatenated as UTF-8 into corpus.bin and a Parquet
+    index records the ticker, filing date, accession number, byte offset and length of each one, so loading a ticker's
+    filings is an index filter plus slices of a memory map instead of opening one file per filing.  Several processes,
+    such as the app and the pipeline, may write to the same store: appends and index writes happen under a lock file,
+    and the index on disk is re-read whenever another writer changed it.  Use get_corpus to share one instance within a
+    process.
+    :param folder: string folder name of the store
+    '''
+
+    def __init__(self, folder="mda_corpus"):
+        self.folder = folder
+        self.data_path = os.path.join(folder, "corpus.bin")
+        self.index_path = os.path.join(folder, "index.parquet")
+        self.lock_path = os.path.join(folder, "corpus.lock")
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.index = pd.DataFrame({
+            "ticker": pd.Series(dtype="string"),
+            "filing_date": pd.Series(dtype="datetime64[ns]"),
+            "accession_no": pd.Series(dtype="string"),
+            "offset": pd.Series(dtype="int64"),
+            "length": pd.Series(dtype="int64"),
+            "sha256": pd.Series(dtype="string"),
+        })
+        self._index_stamp = None
+        self._pending = []
+        self._accessions = set()
+        with self._lock:
+            self._reload()
+
+    def _reload(self):
+        # Re-read the index when another writer replaced it since it was last read, called with self._lock held
+        try:
+            stat = os.stat(self.index_path)
+        except FileNotFoundError:
+            return
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp == self._index_stamp:
+            return
+        self.index = pd.read_parquet(self.index_path)
+        self._index_stamp = stamp
+        self._accessions = set(self.index["accession_no"]) | {row["accession_no"] for row in self._pending}
+
+    def __contains__(self, accession_no):
+        with self._lock:
+            self._reload()
+            return accession_no in self._accessions
+
+    def append(self, ticker, filing_date, accession_no, text):
+        '''
+        Add a filing's MD&A to the end of the store unless it is already in it.  Call flush to persist the index.
+        :param ticker: string stock ticker identifier
+        :param filing_date: filing date as 'YYYY-MM-DD'
+        :param accession_no: accession number of the filing
+        :param text: MD&A text
+        :return: True if the text was added
+        '''
+        data = text.encode("utf-8")
+        with self._lock, file_lock(self.lock_path):
+            self._reload()
+            if accession_no in self._accessions:
+                return False
+            self._accessions.add(accession_no)
+            with open(self.data_path, "ab") as f:
+                # Another process may have appended since the file was opened, the lock keeps it from doing so now
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            self._pending.append({
+                "ticker": ticker,
+                "filing_date": pd.Timestamp(filing_date),
+                "accession_no": accession_no,
+                "offset": offset,
+                "length": len(data),
+                "sha256": hashlib.sha256(data).hexdigest(),
+            })
+        return True
+
+    def flush(self):
+        '''
+        Write the index with everything appended so far, merged with what other writers added to it in the meantime.
+        A filing appended by two writers before either flushed is kept once, at its first offset.
+        '''
+        with self._lock, file_lock(self.lock_path):
+            if not self._pending:
+                return
+            self._reload()
+            index = pd.concat([self.index, pd.DataFrame(self._pending)], ignore_index=True)
+            self.index = index.drop_duplicates(subset="accession_no", keep="first", ignore_index=True)
+            self._pending = []
+            tmp_path = f"{self.index_path}.tmp"
+            pq.write_table(pa.Table.from_pandas(self.index, preserve_index=False), tmp_path)
+            os.replace(tmp_path, self.index_path)
+            stat = os.stat(self.index_path)
+            self._index_stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def documents(self, ticker=None, start=None, end=None):
+        '''
+        Select filings from the index.
+        :param ticker: optional ticker to restrict to
+        :param start: optional first filing date
+        :param end: optional last filing date
+        :return: data frame of the matching index rows sorted by ticker and filing date
+        '''
+        with self._lock:
+            self._reload()
+            selected = self.index
+        if ticker is not None:
+            selected = selected[selected["ticker"] == ticker]
+        if start is not None:
+            selected = selected[selected["filing_date"] >= pd.Timestamp(start)]
+        if end is not None:
+            selected = selected[selected["filing_date"] <= pd.Timestamp(end)]
+        return selected.sort_values(["ticker", "filing_date"])
+
+    def read(self, ticker=None, start=None, end=None):
+        '''
+        Load the texts of the matching filings through a memory map of the store.
+        :return: data frame of the index rows with a text column
+        '''
+        selected = self.documents(ticker, start, end).copy()
+        selected["text"] = self.texts(selected)
+        return selected
+
+    def texts(self, selected):
+        '''
+        Load the texts of index rows through a memory map of the store.
+        :param selected: data frame of index rows, e.g. from documents
+        :return: list of the texts in the order of the rows
+        '''
+        if selected.empty or not os.path.exists(self.data_path) or not os.path.getsize(self.data_path):
+            return [""] * len(selected)
+        with open(self.data_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return [data[offset:offset + length].decode("utf-8")
+                    for offset, length in zip(selected["offset"], selected["length"])]
+
+
+_corpora = {}
+_corpora_lock = threading.Lock()
+
+
+def get_corpus(folder="mda_corpus"):
+    '''
+    The MdaCorpus of a folder shared by everything in the process, so the fetch, sentiment, indexing and keyword stages
+    see each other's appends without re-reading the index.
+    :param folder: string folder name of the store
+    :return: the MdaCorpus
+    '''
+    with _corpora_lock:
+        if folder not in _corpora:
+            _corpora[folder] = MdaCorpus(folder)
+        return _corpora[folder]
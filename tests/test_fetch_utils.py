@@ -0,0 +1,95 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fetch_utils
+from fetch_utils import RateLimiter, with_retries
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    # Record the backoff waits instead of sleeping through them
+    waits = []
+    monkeypatch.setattr(fetch_utils.time, "sleep", waits.append)
+    return waits
+
+
+def test_retries_throttled_responses_and_honours_retry_after(sleeps):
+    responses = iter([FakeResponse(429, {"Retry-After": "5"}), FakeResponse(503), FakeResponse(200)])
+    assert with_retries(lambda: next(responses), backoff=1.0).status_code == 200
+    assert sleeps == [5.0, 2.0]
+
+
+def test_returns_last_error_response_when_out_of_tries(sleeps):
+    responses = iter([FakeResponse(500), FakeResponse(500)])
+    assert with_retries(lambda: next(responses), attempts=2).status_code == 500
+    assert len(sleeps) == 1
+
+
+def test_client_errors_are_not_retried(sleeps):
+    assert with_retries(lambda: FakeResponse(404)).status_code == 404
+    assert sleeps == []
+
+
+def test_raises_after_last_attempt(sleeps):
+    def fail():
+        raise ConnectionError("down")
+
+    with pytest.raises(ConnectionError):
+        with_retries(fail, attempts=3)
+    assert len(sleeps) == 2
+
+
+def test_limiter_takes_one_token_per_request():
+    limiter = RateLimiter(rate=1, capacity=8)
+    with_retries(lambda: FakeResponse(200), limiter=limiter, tokens=4)
+    assert limiter._tokens == pytest.approx(4, abs=0.1)
+
+
+class StubEdgar(BaseHTTPRequestHandler):
+    # Throttles the first request for every path, then serves a submissions file with one 10-Q
+    seen = set()
+
+    def do_GET(self):
+        if self.path not in self.seen:
+            self.seen.add(self.path)
+            self.send_response(429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        body = json.dumps({"filings": {"recent": {
+            "form": ["10-Q", "8-K"], "filingDate": ["2024-05-01", "2024-04-01"],
+            "accessionNumber": ["0000320193-24-000001", "0000320193-24-000002"],
+            "primaryDocument": ["q.htm", "k.htm"],
+        }}}).encode()
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_sec_api_against_stub_server(tmp_path, monkeypatch, sleeps):
+    pytest.importorskip("requests")
+    import response_cache
+    import sec_api
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubEdgar)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        monkeypatch.setattr(sec_api, "SEC_DATA_URL", f"http://127.0.0.1:{server.server_port}")
+        monkeypatch.setattr(response_cache, "_cache", response_cache.ResponseCache(folder=str(tmp_path)))
+        reports = sec_api.get_10q_filings(320193)
+    finally:
+        server.shutdown()
+
+    assert [report["accessionNumber"] for report in reports] == ["0000320193-24-000001"]
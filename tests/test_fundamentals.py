@@ -0,0 +1,81 @@
+import os
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+pa = pytest.importorskip("pyarrow")
+
+import pyarrow.parquet as pq  # noqa: E402
+
+from fundamentals import build_panel, one_per_period, resolve_facts  # noqa: E402
+
+# Columns of the facts table edgartools 3.0.1 returns and load_company_facts saves, it has no unit
+EDGARTOOLS_COLUMNS = ["namespace", "fact", "val", "accn", "start", "end", "fy", "fp", "form", "filed", "frame"]
+
+
+def facts_frame(rows):
+    frame = pd.DataFrame(rows, columns=["Ticker", "fact", "unit", "val", "accn", "start", "end", "form", "filed"])
+    for column in ("start", "end", "filed"):
+        frame[column] = pd.to_datetime(frame[column])
+    return frame
+
+
+def test_resolve_facts_keeps_units_apart_and_flags_restatements():
+    facts = facts_frame([
+        ("AAPL", "Revenues", "USD", 100.0, "a1", "2023-04-02", "2023-07-01", "10-Q", "2023-08-04"),
+        ("AAPL", "Revenues", "USD", 110.0, "a2", "2023-04-02", "2023-07-01", "10-Q", "2024-08-02"),
+        ("AAPL", "Revenues", "EUR", 90.0, "a1", "2023-04-02", "2023-07-01", "10-Q", "2023-08-04"),
+    ])
+    original = resolve_facts(facts).set_index("unit")
+    assert original.loc["USD", "val"] == 100.0 and original.loc["USD", "restated"]
+    assert original.loc["EUR", "val"] == 90.0 and not original.loc["EUR", "restated"]
+    assert resolve_facts(facts, "latest").set_index("unit").loc["USD", "val"] == 110.0
+
+
+def test_one_per_period_keeps_the_main_unit_and_the_longest_period():
+    facts = facts_frame([
+        ("AAPL", "Revenues", "USD", 100.0, "a1", "2023-04-02", "2023-07-01", "10-Q", "2023-08-04"),
+        ("AAPL", "Revenues", "USD", 101.0, "a2", "2023-04-01", "2023-07-01", "10-Q", "2023-08-05"),
+        ("AAPL", "Revenues", "USD", 120.0, "a3", "2023-07-02", "2023-09-30", "10-Q", "2023-11-03"),
+        ("AAPL", "Revenues", "EUR", 90.0, "a1", "2023-04-02", "2023-07-01", "10-Q", "2023-08-04"),
+    ])
+    cells = one_per_period(resolve_facts(facts))
+    assert list(cells["unit"]) == ["USD", "USD"]
+    assert list(cells["val"]) == [101.0, 120.0]
+
+
+def write_edgartools_facts(folder, ticker, rows):
+    os.makedirs(folder, exist_ok=True)
+    columns = {name: [] for name in EDGARTOOLS_COLUMNS}
+    for fact, val, accn, start, end, filed in rows:
+        for name, value in zip(EDGARTOOLS_COLUMNS, ("us-gaap", fact, val, accn, start, end, int(end[:4]), "Q2",
+                                                    "10-Q", filed, None)):
+            columns[name].append(value)
+    pq.write_table(pa.table(columns), os.path.join(folder, f"{ticker}.parquet"))
+
+
+def test_build_panel_reads_edgartools_facts_without_a_unit(tmp_path):
+    folder = str(tmp_path / "facts_cache")
+    write_edgartools_facts(folder, "AAPL", [
+        ("Assets", 350.0, "a1", None, "2023-07-01", "2023-08-04"),
+        # 52/53 week calendars give the same quarter end two start dates
+        ("Revenues", 81.0, "a1", "2023-04-02", "2023-07-01", "2023-08-04"),
+        ("Revenues", 82.0, "a2", "2023-04-01", "2023-07-01", "2023-11-03"),
+    ])
+    panel = build_panel(["AAPL"], concepts=("Assets", "Revenues"), facts_folder=folder, max_workers=1)
+    assert len(panel) == 1
+    assert panel.loc[0, "Assets"] == 350.0
+    assert panel.loc[0, "Revenues"] == 82.0
+    assert panel.loc[0, "filed"] == pd.Timestamp("2023-08-04")
+
+
+def test_build_panel_without_any_facts(tmp_path, monkeypatch):
+    import fundamentals
+
+    def unavailable(ticker, folder):
+        raise OSError("EDGAR is not reachable")
+
+    monkeypatch.setattr(fundamentals, "load_company_facts", unavailable)
+    panel = build_panel(["AAPL"], facts_folder=str(tmp_path), max_workers=1)
+    assert panel.empty
+    assert list(panel.columns) == ["Ticker", "period_end", "filed", "restated"]
@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip("scipy")
+pytest.importorskip("sklearn")
+
+from keyword_index import KeywordIndex  # noqa: E402
+from storage import MdaCorpus  # noqa: E402
+
+
+def make_corpus(folder, filings):
+    corpus = MdaCorpus(folder)
+    for ticker, filing_date, accession_no, text in filings:
+        corpus.append(ticker, filing_date, accession_no, text)
+    corpus.flush()
+    return corpus
+
+
+def test_writers_sharing_a_folder_keep_each_others_filings(tmp_path):
+    folder = str(tmp_path / "keyword_index")
+    apple = make_corpus(str(tmp_path / "apple"), [("AAPL", "2023-08-04", "a1", "iPhone revenue grew strongly")])
+    microsoft = make_corpus(str(tmp_path / "microsoft"), [("MSFT", "2023-07-27", "m1", "Azure cloud revenue grew")])
+
+    # Both are opened before either saves, as the app and the pipeline are
+    first, second = KeywordIndex(folder, n_features=2 ** 12), KeywordIndex(folder, n_features=2 ** 12)
+    assert first.update(apple) == 1
+    assert second.update(microsoft) == 1
+
+    reopened = KeywordIndex(folder)
+    assert sorted(reopened.documents["accession_no"]) == ["a1", "m1"]
+    assert reopened.counts.shape[0] == 2
+    # The first writer sees the second one's filing without being reopened
+    assert list(first.search("azure", k=1)["accession_no"]) == ["m1"]
+
+
+def test_update_then_reopen(tmp_path):
+    folder = str(tmp_path / "keyword_index")
+    corpus = make_corpus(str(tmp_path / "corpus"), [
+        ("AAPL", "2023-05-05", "a1", "iPhone revenue grew on strong demand"),
+        ("AAPL", "2023-08-04", "a2", "Supply chain constraints reduced iPhone revenue"),
+    ])
+    index = KeywordIndex(folder, n_features=2 ** 12)
+    assert index.update(corpus) == 2
+    assert index.update(corpus) == 0
+
+    corpus.append("AAPL", "2023-11-03", "a3", "Services revenue grew while supply chain costs fell")
+    corpus.flush()
+    reopened = KeywordIndex(folder)
+    assert reopened.n_features == 2 ** 12
+    assert reopened.update(corpus) == 1
+    assert len(KeywordIndex(folder)) == 3
+
+    assert list(reopened.search("supply chain", ticker="AAPL", k=5)["accession_no"]) == ["a2", "a3"]
+    assert set(reopened.top_terms("AAPL", n=2)["accession_no"]) == {"a1", "a2", "a3"}
+    drift = reopened.term_drift("AAPL")
+    assert list(drift["accession_no"]) == ["a2", "a3"]
+    assert "supply chain" in drift.loc[0, "rising"]
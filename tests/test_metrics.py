@@ -0,0 +1,37 @@
+import os
+import threading
+
+import metrics
+from metrics import profile, serve_from_env
+
+
+def test_concurrent_profiles_run_one_at_a_time(tmp_path, monkeypatch):
+    monkeypatch.setenv("EDGAR_PROFILE", str(tmp_path))
+    errors = []
+
+    def stage(name):
+        try:
+            with profile(name):
+                sum(range(10000))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=stage, args=(f"stage{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert sorted(os.listdir(tmp_path)) == sorted(f"stage{i}-{os.getpid()}.prof" for i in range(4))
+
+
+def test_metrics_server_only_starts_when_asked(monkeypatch):
+    monkeypatch.setenv("EDGAR_METRICS_PORT", "0")
+    monkeypatch.setattr(metrics, "_server", None)
+    server = serve_from_env()
+    try:
+        assert server is not None
+        assert serve_from_env() is server
+    finally:
+        server.shutdown()
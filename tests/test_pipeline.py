@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+pytest.importorskip("pandas")
+
+from pipeline import Pipeline, Stage  # noqa: E402
+
+
+def make_stages(calls, failing=()):
+    def stage(name):
+        def run(params, inputs):
+            calls.append(name)
+            if name in failing:
+                raise ValueError(f"{name} failed")
+            return [name, sorted(inputs)]
+        return run
+
+    return [
+        Stage("assets", stage("assets")),
+        Stage("prices", stage("prices"), deps=("assets",)),
+        Stage("mda", stage("mda")),
+        Stage("sentiment", stage("sentiment"), deps=("mda",)),
+    ]
+
+
+def test_failed_run_resumes_from_checkpoints(tmp_path):
+    folder = str(tmp_path / "checkpoints")
+    params = {"tickers": ["AAPL"], "end": "2024-01-31"}
+    calls = []
+    with pytest.raises(RuntimeError, match="sentiment"):
+        Pipeline(make_stages(calls, failing=("sentiment",)), folder).run(params, max_workers=1)
+    assert sorted(calls) == ["assets", "mda", "prices", "sentiment"]
+
+    calls.clear()
+    results = Pipeline(make_stages(calls), folder).run(params, max_workers=1)
+    assert calls == ["sentiment"]
+    assert results["sentiment"] == ["sentiment", ["mda"]]
+    # Checkpoints only serve resuming, a completed run leaves none behind
+    assert not os.listdir(folder)
+
+    calls.clear()
+    Pipeline(make_stages(calls), folder).run(params, max_workers=1)
+    assert sorted(calls) == ["assets", "mda", "prices", "sentiment"]
+
+
+def test_forced_stage_re_runs_its_dependents(tmp_path):
+    folder = str(tmp_path / "checkpoints")
+    params = {"tickers": ["AAPL"], "end": "2024-01-31"}
+    calls = []
+    with pytest.raises(RuntimeError):
+        Pipeline(make_stages(calls, failing=("assets",)), folder).run(params, max_workers=1)
+
+    # mda and sentiment completed, forcing mda runs sentiment again too
+    calls.clear()
+    Pipeline(make_stages(calls), folder).run(params, force=("mda",), max_workers=1)
+    assert sorted(calls) == ["assets", "mda", "prices", "sentiment"]
+
+
+def test_other_parameters_do_not_resume(tmp_path):
+    folder = str(tmp_path / "checkpoints")
+    calls = []
+    with pytest.raises(RuntimeError):
+        Pipeline(make_stages(calls, failing=("prices",)), folder).run({"end": "2024-01-31"}, max_workers=1)
+
+    calls.clear()
+    Pipeline(make_stages(calls), folder).run({"end": "2024-02-01"}, max_workers=1)
+    assert sorted(calls) == ["assets", "mda", "prices", "sentiment"]
@@ -0,0 +1,12 @@
+import pytest
+
+pytest.importorskip("pandas")
+
+from ProjectEdgarGetData import get_prices  # noqa: E402
+
+
+@pytest.mark.parametrize("ticker_filed_dates", [{}, {"AAPL": []}])
+def test_get_prices_without_filing_dates(ticker_filed_dates):
+    prices = get_prices(ticker_filed_dates)
+    assert prices.empty
+    assert list(prices.columns) == ["Ticker", "Date", "Adj Close", "Interperiod Return Pct"]
@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("langchain_community")
+
+from langchain_core.documents import Document  # noqa: E402
+
+from qa_engine import AnswerEngine, SemanticCache, StubChatModel, get_llm  # noqa: E402
+
+
+class StubEmbeddings:
+    def embed_query(self, text):
+        return [1.0, float(len(text))]
+
+
+class StubDocstore:
+    def __init__(self, docs):
+        self._dict = {str(i): doc for i, doc in enumerate(docs)}
+
+
+class StubVectorStore:
+    # Only what AnswerEngine and ticker_fetch_k use of a FAISS store
+    def __init__(self, docs):
+        self.docstore = StubDocstore(docs)
+        self.index_to_docstore_id = dict(enumerate(self.docstore._dict))
+        self.searches = 0
+
+    def similarity_search_by_vector(self, vector, k=4, filter=None, fetch_k=20):
+        self.searches += 1
+        return [doc for doc in self.docstore._dict.values() if doc.metadata["ticker"] == filter["ticker"]][:k]
+
+
+def test_stub_llm_answers_from_the_context():
+    docs = [Document(page_content="Revenue grew by 12%. Margins were stable. Costs fell.",
+                     metadata={"ticker": "AAPL", "filing_date": "2023-08-04"}),
+            Document(page_content="Revenue fell.", metadata={"ticker": "MSFT", "filing_date": "2023-07-27"})]
+    store = StubVectorStore(docs)
+    engine = AnswerEngine(store, StubEmbeddings(), StubChatModel(), k=1)
+
+    answer = engine.answer("AAPL", "How did revenue change?")
+    assert answer == "According to the filings: Revenue grew by 12%. Margins were stable. Costs fell."
+    assert list(engine.stream("AAPL", "How did revenue change?")) == [answer]
+    assert store.searches == 1
+
+
+def test_get_llm_needs_an_openai_key(monkeypatch):
+    monkeypatch.delenv("QA_LLM", raising=False)
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    with pytest.raises(RuntimeError, match="OPENAI_API_KEY"):
+        get_llm()
+    assert isinstance(get_llm("stub"), StubChatModel)
+
+
+def test_semantic_cache_drops_least_recently_used_namespaces():
+    cache = SemanticCache(max_entries=2, max_namespaces=2)
+    cache.put("AAPL@10", [1.0, 0.0], "a", [])
+    cache.put("AAPL@20", [1.0, 0.0], "b", [])
+    assert cache.get("AAPL@10", [1.0, 0.0]) == ("a", [])
+    cache.put("MSFT@5", [0.0, 1.0], "c", [])
+
+    assert cache.get("AAPL@20", [1.0, 0.0]) is None
+    assert cache.get("AAPL@10", [1.0, 0.0]) == ("a", [])
+    assert cache.get("MSFT@5", [0.0, 1.0]) == ("c", [])
@@ -0,0 +1,54 @@
+import response_cache
+from response_cache import ResponseCache
+
+
+def test_cached_values_survive_reopening(tmp_path):
+    calls = []
+
+    def produce():
+        calls.append(1)
+        return {"filings": [1, 2, 3]}
+
+    cache = ResponseCache(folder=str(tmp_path))
+    assert cache.cached("submissions:320193", produce) == {"filings": [1, 2, 3]}
+    reopened = ResponseCache(folder=str(tmp_path))
+    assert reopened.cached("submissions:320193", produce) == {"filings": [1, 2, 3]}
+    assert len(calls) == 1
+
+
+def test_entries_expire_after_their_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(folder=str(tmp_path))
+    cache.put("prices:AAPL", b"old", ttl=60)
+    cache.put("mda:a1", b"filing")
+    now[0] += 61
+    assert cache.get("prices:AAPL") is None
+    assert cache.get("mda:a1") == b"filing"
+
+
+def test_missing_results_are_produced_again_later(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(folder=str(tmp_path))
+    results = iter([None, "Item 2 text"])
+    assert cache.cached("mda:a1", lambda: next(results), missing_ttl=60) is None
+    assert cache.cached("mda:a1", lambda: "not called", missing_ttl=60) is None
+    now[0] += 61
+    assert cache.cached("mda:a1", lambda: next(results), missing_ttl=60) == "Item 2 text"
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(response_cache.time, "time", lambda: now[0])
+    cache = ResponseCache(folder=str(tmp_path), max_bytes=10)
+    cache.put("mda:a1", b"aaaa")
+    now[0] += 1
+    cache.put("mda:a2", b"bbbb")
+    now[0] += 1
+    assert cache.get("mda:a1") == b"aaaa"
+    now[0] += 1
+    cache.put("mda:a3", b"cccc")
+    assert cache.get("mda:a2") is None
+    assert cache.get("mda:a1") == b"aaaa"
+    assert cache.total_bytes() == 8
@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("nltk")
+
+import sentiment_analysis  # noqa: E402
+from sentiment_analysis import preprocess_filings, preprocessed_path  # noqa: E402
+from storage import MdaCorpus  # noqa: E402
+
+
+def test_preprocessed_text_is_kept_in_the_corpus_store(tmp_path, monkeypatch):
+    monkeypatch.setattr(sentiment_analysis, "_stop_words", frozenset({"the", "by"}))
+    corpus = MdaCorpus(str(tmp_path / "corpus"))
+    corpus.append("AAPL", "2023-08-04", "0000320193-23-000077", "The revenue grew by 12 percent.")
+    corpus.flush()
+    filings = corpus.read("AAPL")
+
+    assert preprocess_filings(filings, corpus, processes=1) == ["revenue grew percent"]
+    assert os.path.exists(preprocessed_path(corpus, filings["sha256"].iloc[0]))
+
+    # A later run reads the stored text instead of preprocessing again
+    calls = []
+    monkeypatch.setattr(sentiment_analysis, "preprocess_text", lambda text: calls.append(text))
+    assert preprocess_filings(filings, corpus, processes=1) == ["revenue grew percent"]
+    assert not calls
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("pyarrow")
+
+from storage import MdaCorpus, read_table, write_table  # noqa: E402
+
+
+def test_corpus_appends_survive_reopening(tmp_path):
+    folder = str(tmp_path / "corpus")
+    corpus = MdaCorpus(folder)
+    assert corpus.append("AAPL", "2023-08-04", "a2", "Second quarter text.")
+    assert corpus.append("AAPL", "2023-05-05", "a1", "First quarter text, with ünïcode.")
+    assert not corpus.append("AAPL", "2023-05-05", "a1", "First quarter text, with ünïcode.")
+    corpus.flush()
+
+    reopened = MdaCorpus(folder)
+    assert "a1" in reopened and "b1" not in reopened
+    filings = reopened.read("AAPL")
+    assert list(filings["accession_no"]) == ["a1", "a2"]
+    assert list(filings["text"]) == ["First quarter text, with ünïcode.", "Second quarter text."]
+    assert list(reopened.read("AAPL", start="2023-06-01")["accession_no"]) == ["a2"]
+    assert reopened.read("MSFT").empty
+
+
+def test_corpus_writers_sharing_a_folder_merge_their_filings(tmp_path):
+    folder = str(tmp_path / "corpus")
+    first, second = MdaCorpus(folder), MdaCorpus(folder)
+    first.append("AAPL", "2023-08-04", "a1", "Apple text.")
+    second.append("MSFT", "2023-07-27", "m1", "Microsoft text.")
+    # Appended by both before either flushed, kept once
+    first.append("MSFT", "2023-10-24", "m2", "Microsoft later text.")
+    second.append("MSFT", "2023-10-24", "m2", "Microsoft later text.")
+    first.flush()
+    second.flush()
+
+    filings = MdaCorpus(folder).read()
+    assert sorted(filings["accession_no"]) == ["a1", "m1", "m2"]
+    assert dict(zip(filings["accession_no"], filings["text"]))["m1"] == "Microsoft text."
+    # The first writer sees what the second one flushed
+    assert "m1" in first
+
+
+def test_tables_round_trip_with_typed_dates(tmp_path):
+    import pandas as pd
+
+    path = str(tmp_path / "assets.parquet")
+    write_table(pd.DataFrame({"Ticker": ["AAPL", "MSFT"], "filed": ["2023-08-04", "2023-07-27"],
+                              "val": [1.0, 2.0]}), path)
+    table = read_table(path, filters=[("Ticker", "==", "MSFT")])
+    assert list(table["val"]) == [2.0]
+    assert pd.api.types.is_datetime64_any_dtype(table["filed"])
@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("faiss")
+pytest.importorskip("sklearn")
+pytest.importorskip("langchain_community")
+
+from embedding_cache import HashingEmbeddings  # noqa: E402
+from storage import MdaCorpus  # noqa: E402
+from vector_index import indexed_ids, load_vector_store, update_vector_store  # noqa: E402
+
+
+class ParagraphSplitter:
+    def split_text(self, text):
+        return [paragraph for paragraph in text.split("\n\n") if paragraph]
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    corpus = MdaCorpus(str(tmp_path / "corpus"))
+    corpus.append("AAPL", "2023-08-04", "0000320193-23-000077", "Revenue grew.\n\nMargins were stable.")
+    corpus.append("MSFT", "2023-07-27", "0000950170-23-035122", "Cloud revenue grew.\n\nCosts fell.")
+    corpus.flush()
+    return corpus
+
+
+def test_update_adds_only_new_chunks(tmp_path, corpus):
+    folder, embeddings = str(tmp_path / "vector_store"), HashingEmbeddings(dim=32)
+    assert update_vector_store(corpus, folder, "AAPL", 2023, ParagraphSplitter(), embeddings) == 2
+    assert update_vector_store(corpus, folder, "AAPL", 2023, ParagraphSplitter(), embeddings) == 0
+    assert len(indexed_ids(load_vector_store(folder, embeddings))) == 2
+
+
+def test_concurrent_writers_keep_each_others_chunks(tmp_path, corpus):
+    folder = str(tmp_path / "vector_store")
+
+    class OtherWriterEmbeddings(HashingEmbeddings):
+        # Another writer saves the store while this one is embedding its chunks
+        model_name = "hashing-32"
+
+        def embed_documents(self, texts):
+            if texts and texts[0] == "Revenue grew.":
+                update_vector_store(corpus, folder, "MSFT", 2023, ParagraphSplitter(), self)
+            return super().embed_documents(texts)
+
+    embeddings = OtherWriterEmbeddings(dim=32)
+    assert update_vector_store(corpus, folder, "AAPL", 2023, ParagraphSplitter(), embeddings) == 2
+    tickers = {doc.metadata["ticker"] for doc in load_vector_store(folder, embeddings).docstore._dict.values()}
+    assert tickers == {"AAPL", "MSFT"}
@@ -0,0 +1,85 @@
+import bisect
+import json
+import os
+from functools import lru_cache
+
+TICKERS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "company_tickers.json")
+
+
+@lru_cache(maxsize=None)
+def _load(path=TICKERS_FILE):
+    '''
+    Parse company_tickers.json once per process and build the lookup tables.
+    :param path: path of SEC's company_tickers.json
+    :return: ticker -> (cik, title) dict, cik -> ticker dict and a sorted list of (lowercase title, ticker) pairs
+    '''
+    with open(path, encoding="utf-8") as f:
+        company_data = json.load(f)
+
+    by_ticker = {}
+    by_cik = {}
+    titles = []
+    # The file lists companies by market value, so the first ticker seen for a CIK is its main listing
+    for info in company_data.values():
+        ticker = info["ticker"].upper()
+        cik = int(info["cik_str"])
+        by_ticker.setdefault(ticker, (cik, info["title"]))
+        by_cik.setdefault(cik, ticker)
+        titles.append((info["title"].lower(), ticker))
+    titles.sort()
+
+    return by_ticker, by_cik, titles
+
+
+def ticker_to_cik(ticker):
+    '''
+    :param ticker: string stock ticker identifier, any case
+    :return: integer CIK or None if the ticker is unknown
+    '''
+    entry = _load()[0].get(ticker.upper())
+    return entry[0] if entry else None
+
+
+def cik_to_ticker(cik):
+    '''
+    :param cik: integer or string CIK
+    :return: main ticker of the company or None if the CIK is unknown
+    '''
+    return _load()[1].get(int(cik))
+
+
+def company_title(ticker):
+    '''
+    :param ticker: string stock ticker identifier, any case
+    :return: company name as registered with SEC or None if the ticker is unknown
+    '''
+    entry = _load()[0].get(ticker.upper())
+    return entry[1] if entry else None
+
+
+def all_tickers():
+    '''
+    :return: list of every ticker in company_tickers.json, in the file's order
+    '''
+    return list(_load()[0])
+
+
+def search_titles(prefix, limit=10):
+    '''
+    Case-insensitive prefix search over company names using binary search on the sorted titles.
+    :param prefix: start of the company name, e.g. 'micro'
+    :param limit: maximum number of matches
+    :return: list of (ticker, title) pairs
+    '''
+    by_ticker, _, titles = _load()
+    prefix = prefix.lower()
+    matches = []
+    # Step through the titles from the first match by position, neither copying nor skipping over the list before it
+    position = bisect.bisect_left(titles, (prefix, ""))
+    while position < len(titles) and len(matches) < limit:
+        title, ticker = titles[position]
+        if not title.startswith(prefix):
+            break
+        matches.append((ticker, by_ticker[ticker][1]))
+        position += 1
+    return matches
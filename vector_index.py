@@ -0,0 +1,462 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+from metrics import METRICS, serve_from_env
+from storage import file_lock, get_corpus
+
+# Layout of new indexes, any faiss.index_factory string: "Flat" is exact, "HNSW32" is a graph index that needs no
+# training and "IVF4096,PQ64" clusters and compresses the vectors for universe-scale corpora
+INDEX_SPEC = os.environ.get("FAISS_INDEX", "Flat")
+
+# Search-time accuracy/speed trade-off of the approximate indexes, lists probed by IVF and candidates kept by HNSW
+NPROBE = int(os.environ.get("FAISS_NPROBE", "16"))
+EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
+
+# Vectors sampled to train IVF centroids and PQ codebooks
+TRAIN_SAMPLE = 100_000
+
+# Stores are saved and loaded under this lock and a lock file next to them, so the app's chatbot never reads an index
+# and docstore from two different saves while the pipeline or another job is writing them
+_store_lock = threading.Lock()
+
+
+class InstrumentedFAISS(FAISS):
+    '''
+    FAISS vector store that times every nearest neighbour search, whichever retriever or chain issues it.
+    '''
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        with METRICS.timer("faiss_search_seconds"):
+            return super().similarity_search_with_score_by_vector(embedding, k=k, filter=filter, fetch_k=fetch_k,
+                                                                  **kwargs)
+
+
+def chunk_hash(text):
+    '''
+    :param text: string chunk of text
+    :return: sha256 hex digest of the chunk, used to tell whether it has been embedded before
+    '''
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def min_training_points(index):
+    '''
+    :param index: untrained faiss index
+    :return: number of vectors needed to train it, one per IVF list and per PQ centroid
+    '''
+    needed = 1
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        needed = max(needed, ivf.nlist)
+        if hasattr(ivf, "pq"):
+            needed = max(needed, ivf.pq.ksub)
+    if hasattr(index, "pq"):
+        needed = max(needed, index.pq.ksub)
+    return needed
+
+
+def training_target(index, spec=INDEX_SPEC):
+    '''
+    An exact index stands in for a layout that needs training until there are enough vectors to train it, see
+    build_index.
+    :param index: faiss index of a store
+    :param spec: faiss.index_factory string of the layout new indexes should have
+    :return: number of vectors needed to train spec when the index is such a stand-in, otherwise None
+    '''
+    if not isinstance(index, faiss.IndexFlat):
+        return None
+    target = faiss.index_factory(index.d, spec)
+    if target.is_trained:
+        return None
+    return min_training_points(target)
+
+
+def tune_index(index, nprobe=NPROBE, ef_search=EF_SEARCH):
+    '''
+    Set the search-time parameters of an approximate index, exact indexes are left alone.
+    :param index: faiss index
+    :param nprobe: number of IVF lists searched per query
+    :param ef_search: size of the HNSW candidate list per query
+    :return: the index
+    '''
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def build_index(vectors, spec=INDEX_SPEC, train_sample=TRAIN_SAMPLE, seed=0):
+    '''
+    Create an empty index from a factory string, training it on a random sample of the vectors when the layout needs
+    it.  Too few vectors to train falls back to an exact index so small corpora always work, update_vector_store
+    rebuilds it in the requested layout once the store has grown enough.
+    :param vectors: float32 array of shape (n, dim) the index will hold
+    :param spec: faiss.index_factory string, e.g. 'Flat', 'HNSW32' or 'IVF1024,PQ32'
+    :param train_sample: maximum number of vectors used for training
+    :param seed: random seed of the training sample
+    :return: trained, empty faiss index
+    '''
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    index = faiss.index_factory(vectors.shape[1], spec)
+    if not index.is_trained:
+        if len(vectors) < min_training_points(index):
+            print(f"{len(vectors)} vectors are too few to train {spec}, using an exact index for now")
+            return faiss.IndexFlatL2(vectors.shape[1])
+        sample = vectors
+        if len(vectors) > train_sample:
+            sample = vectors[np.random.default_rng(seed).choice(len(vectors), train_sample, replace=False)]
+        with METRICS.timer("faiss_train_seconds", spec=spec):
+            index.train(sample)
+    return tune_index(index)
+
+
+def model_name_of(embeddings):
+    '''
+    :param embeddings: langchain embeddings
+    :return: name of the model behind the embeddings, CachedEmbeddings knows it and anything else goes by its class
+    '''
+    return getattr(embeddings, "model_name", None) or type(embeddings).__name__
+
+
+def store_folder(vector_store_folder, embeddings):
+    '''
+    Vectors of different embedding models can not be searched together and mostly differ in size too, so every model
+    keeps its own store in a subfolder named after it, e.g. 'vector_store/openai-text-embedding-ada-002'.
+    :param vector_store_folder: string folder name of the stores
+    :param embeddings: langchain embeddings the store is built with
+    :return: path of the model's store
+    '''
+    return os.path.join(vector_store_folder, re.sub(r"[^\w.-]", "_", model_name_of(embeddings)))
+
+
+@contextmanager
+def store_lock(vector_store_folder, embeddings):
+    '''
+    Hold the lock of a model's store, shared by the threads of this process and, through a lock file, by other
+    processes such as the app and the pipeline.  It is not reentrant, inside it use _read_store and _write_store.
+    :param vector_store_folder: string folder name of the stores
+    :param embeddings: langchain embeddings the store is built with
+    :return: path of the model's store
+    '''
+    folder = store_folder(vector_store_folder, embeddings)
+    os.makedirs(folder, exist_ok=True)
+    with _store_lock, file_lock(os.path.join(folder, "store.lock")):
+        yield folder
+
+
+def _write_store(vector_store, folder):
+    # Written to a temporary folder and moved into place, called with the store lock held
+    tmp_folder = f"{folder}.tmp"
+    vector_store.save_local(tmp_folder)
+    with open(os.path.join(tmp_folder, "store.json"), "w", encoding="utf-8") as f:
+        json.dump({"model": model_name_of(vector_store.embeddings), "dim": vector_store.index.d}, f)
+    for name in ("index.pkl", "store.json", "index.faiss"):
+        os.replace(os.path.join(tmp_folder, name), os.path.join(folder, name))
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def save_vector_store(vector_store, vector_store_folder):
+    '''
+    Save the index and docstore of a store, with the model and size of its vectors in store.json next to them.  The
+    files are written to a temporary folder and then moved into place, so a reader that memory-mapped the old index
+    keeps its file instead of seeing it truncated.  This replaces whatever is saved, to add to a store that other
+    writers may be adding to use update_vector_store.
+    :param vector_store: FAISS vector store
+    :param vector_store_folder: string folder name of the stores
+    '''
+    with store_lock(vector_store_folder, vector_store.embeddings) as folder:
+        _write_store(vector_store, folder)
+
+
+def load_vector_store(vector_store_folder, embeddings, mmap=False):
+    '''
+    Load the persisted multi-ticker index of the embeddings' model if there is one.  A store whose vectors do not match
+    the model is refused, it has to be rebuilt with that model or the model changed back.
+    :param vector_store_folder: string folder name of the stores, the model's own store is a subfolder of it
+    :param embeddings: langchain embeddings used to embed queries and new chunks
+    :param mmap: memory-map the inverted lists of an IVF index instead of reading them into RAM, for read-only use such
+    as answering questions.  Only IVF layouts are mapped, faiss reads Flat and HNSW indexes into RAM either way, and
+    the docstore in index.pkl is always loaded
+    :return: FAISS vector store, or None if nothing has been indexed yet or the store only holds untagged chunks
+    '''
+    if not os.path.exists(os.path.join(store_folder(vector_store_folder, embeddings), "index.faiss")):
+        return None
+    # The index and docstore are read under the lock so they come from the same save
+    with store_lock(vector_store_folder, embeddings) as folder:
+        return _read_store(folder, embeddings, mmap)
+
+
+def _read_store(folder, embeddings, mmap=False):
+    # See load_vector_store, called with the store lock held
+    index_path = os.path.join(folder, "index.faiss")
+    if not os.path.exists(index_path):
+        return None
+    index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP if mmap else 0)
+    try:
+        with open(os.path.join(folder, "store.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        meta = {}
+    with open(os.path.join(folder, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    dim = getattr(embeddings, "dim", None) or meta.get("dim")
+    if meta.get("model", model_name_of(embeddings)) != model_name_of(embeddings) or (dim and dim != index.d):
+        raise ValueError(f"The vector store in {folder} holds {index.d} dimension vectors of {meta.get('model')}, "
+                         f"not of {model_name_of(embeddings)}")
+    # Stores from before chunks were tagged with their ticker can never be retrieved from, start a new one instead
+    if not any(doc.metadata.get("ticker") for doc in docstore._dict.values()):
+        print(f"Ignoring the vector store in {folder}, its chunks are not tagged with a ticker")
+        return None
+    return InstrumentedFAISS(embeddings, tune_index(index), docstore, index_to_docstore_id)
+
+
+def rebuild_vector_store(vector_store_folder, embeddings, spec=INDEX_SPEC, train_sample=TRAIN_SAMPLE):
+    '''
+    Move an existing vector store to another index layout, e.g. once the exact index has grown too large.  The stored
+    vectors are reused, nothing is embedded again; rebuilding from a PQ index keeps its compression loss.
+    :param vector_store_folder: string folder name of the stores
+    :param embeddings: langchain embeddings the store was built with
+    :param spec: faiss.index_factory string of the new layout
+    :param train_sample: maximum number of vectors used for training
+    :return: number of vectors in the rebuilt index
+    '''
+    # Held from load to save so chunks another writer adds meanwhile are not lost
+    with store_lock(vector_store_folder, embeddings) as folder:
+        vector_store = _read_store(folder, embeddings)
+        if vector_store is None:
+            return 0
+        old_index = vector_store.index
+        ivf = faiss.try_extract_index_ivf(old_index)
+        if ivf is not None:
+            # IVF indexes only reconstruct vectors by id once they keep a direct map
+            ivf.make_direct_map()
+        vectors = old_index.reconstruct_n(0, old_index.ntotal)
+
+        index = build_index(vectors, spec, train_sample)
+        with METRICS.timer("faiss_add_seconds"):
+            index.add(vectors)
+        vector_store.index = index
+        _write_store(vector_store, folder)
+    print(f"Rebuilt {index.ntotal} vectors as {spec}")
+    return index.ntotal
+
+
+def indexed_ids(vector_store):
+    '''
+    :param vector_store: FAISS vector store
+    :return: set of the document ids already in the index
+    '''
+    if vector_store is None:
+        return set()
+    return set(vector_store.index_to_docstore_id.values())
+
+
+def update_vector_store(corpus, vector_store_folder, ticker, start_year, text_splitter, embeddings):
+    '''
+    Append the MD&A chunks of a ticker to the persistent index, embedding only chunks that are not in it yet.  Every
+    chunk is tagged with its ticker, filing date and content hash, and its id is derived from the ticker and hash so
+    re-running for the same filings adds nothing.  A store that started exact because its first batch was too small
+    to train INDEX_SPEC is rebuilt in that layout, from a sample of all its vectors, once it holds enough of them.
+    :param corpus: MdaCorpus holding the MD&A texts, the shared default store if None
+    :param vector_store_folder: string folder name of the stores
+    :param ticker: string stock ticker identifier
+    :param start_year: year to begin indexing filings
+    :param text_splitter: langchain text splitter used to chunk the filings
+    :param embeddings: langchain embeddings used to embed new chunks
+    :return: number of chunks added to the index
+    '''
+    vector_store = load_vector_store(vector_store_folder, embeddings)
+    existing = indexed_ids(vector_store)
+
+    # Only this ticker's filings for the period, in filing date order
+    if corpus is None:
+        corpus = get_corpus()
+    filings = corpus.read(ticker, start=f"{start_year}-01-01")
+    filing_dates = list(filings["filing_date"].dt.strftime("%Y-%m-%d"))
+    documents = list(filings["text"])
+
+    # Splitters that understand a company's filings as a whole can drop boilerplate repeated between quarters
+    if hasattr(text_splitter, "split_filings"):
+        chunked = text_splitter.split_filings(documents)
+    else:
+        chunked = [text_splitter.split_text(document) for document in documents]
+
+    texts, metadatas, ids = [], [], []
+    for filing_date, chunks in zip(filing_dates, chunked):
+        for text in chunks:
+            content_hash = chunk_hash(text)
+            doc_id = f"{ticker}:{content_hash}"
+            if doc_id in existing:
+                continue
+            existing.add(doc_id)
+            texts.append(text)
+            metadatas.append({"ticker": ticker, "filing_date": filing_date, "hash": content_hash})
+            ids.append(doc_id)
+
+    if not texts:
+        return 0
+
+    # Embedding is the slow part and is done without the lock, another writer may have saved the store since it was
+    # loaded, so it is loaded again under the lock and only the chunks still missing are added to it
+    vectors = embeddings.embed_documents(texts)
+    with METRICS.timer("faiss_add_seconds"), store_lock(vector_store_folder, embeddings) as folder:
+        vector_store = _read_store(folder, embeddings)
+        existing = indexed_ids(vector_store)
+        new = [i for i, doc_id in enumerate(ids) if doc_id not in existing]
+        if not new:
+            return 0
+        if vector_store is None:
+            # The first batch trains the layout, or starts an exact index when it is too small to train it
+            index = build_index(np.array([vectors[i] for i in new], dtype=np.float32))
+            vector_store = InstrumentedFAISS(embeddings, index, InMemoryDocstore(), {})
+        vector_store.add_embeddings([(texts[i], vectors[i]) for i in new], metadatas=[metadatas[i] for i in new],
+                                    ids=[ids[i] for i in new])
+        _write_store(vector_store, folder)
+    METRICS.inc("faiss_chunks_added_total", len(new))
+
+    needed = training_target(vector_store.index)
+    if needed is not None:
+        if vector_store.index.ntotal >= needed:
+            print(f"The vector store holds {vector_store.index.ntotal} vectors, rebuilding it as {INDEX_SPEC}")
+            rebuild_vector_store(vector_store_folder, embeddings)
+        else:
+            print(f"The vector store holds {vector_store.index.ntotal} vectors, too few to train {INDEX_SPEC} "
+                  f"({needed} needed), it stays exact")
+
+    return len(new)
+
+
+def ticker_fetch_k(vector_store, ticker, k=4, filing_dates=None):
+    '''
+    FAISS filters after the nearest neighbour search, so the number of candidates fetched is scaled by how small a
+    share of the index the ticker is.
+    :param vector_store: FAISS vector store
+    :param ticker: string stock ticker identifier
+    :param k: number of chunks to return
+    :param filing_dates: optional list of 'YYYY-MM-DD' filing dates the search is also restricted to
+    :return: number of candidates to fetch before filtering on the ticker
+    '''
+    docs = vector_store.docstore._dict.values()
+    ticker_count = sum(1 for doc in docs if doc.metadata.get("ticker") == ticker
+                       and (filing_dates is None or doc.metadata.get("filing_date") in filing_dates))
+    total = len(vector_store.index_to_docstore_id)
+    return min(max(20, k * total // max(ticker_count, 1)), total)
+
+
+def ticker_retriever(vector_store, ticker, k=4):
+    '''
+    Retriever restricted to one ticker's chunks.
+    :param vector_store: FAISS vector store
+    :param ticker: string stock ticker identifier
+    :param k: number of chunks to return
+    :return: langchain retriever
+    '''
+    return vector_store.as_retriever(search_kwargs={"k": k, "fetch_k": ticker_fetch_k(vector_store, ticker, k),
+                                                    "filter": {"ticker": ticker}})
+
+
+def _synthetic_vectors(rng, n, dim, clusters):
+    # Vectors around random topic centres, closer to real embeddings than uniform noise
+    centres = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centres[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark(n=50_000, dim=384, queries=500, k=10, clusters=200,
+              specs=("HNSW32", "IVF256,Flat", "IVF256,SQ8", "IVF256,PQ48"), nprobes=(1, 4, 16, 64),
+              ef_searches=(16, 64, 256), seed=0):
+    '''
+    Measure recall and latency of index layouts against the exact index on a synthetic corpus.
+    :param n: number of vectors indexed
+    :param dim: embedding size
+    :param queries: number of queries, searched one at a time as the chatbot does
+    :param k: neighbours per query, recall@k is the share of the exact neighbours found
+    :param clusters: number of topic centres the vectors are drawn around
+    :param specs: faiss.index_factory strings to compare
+    :param nprobes: IVF lists probed, tried for every IVF layout
+    :param ef_searches: HNSW candidate list sizes, tried for every HNSW layout
+    :param seed: random seed
+    :return: list of result dictionaries
+    '''
+    rng = np.random.default_rng(seed)
+    vectors = _synthetic_vectors(rng, n + queries, dim, clusters)
+    vectors, query_vectors = vectors[:n], vectors[n:]
+
+    def measure(index):
+        start_time = time.perf_counter()
+        found = np.vstack([index.search(query_vectors[i:i + 1], k)[1] for i in range(queries)])
+        return found, (time.perf_counter() - start_time) / queries * 1000
+
+    exact = faiss.IndexFlatL2(dim)
+    exact.add(vectors)
+    truth, exact_ms = measure(exact)
+    results = [{"spec": "Flat", "param": "", "recall": 1.0, "ms_per_query": exact_ms, "build_s": 0.0,
+                "mb": faiss.serialize_index(exact).nbytes / 1024 ** 2}]
+
+    for spec in specs:
+        start_time = time.perf_counter()
+        index = build_index(vectors, spec, seed=seed)
+        index.add(vectors)
+        build_time = time.perf_counter() - start_time
+        size = faiss.serialize_index(index).nbytes / 1024 ** 2
+
+        if faiss.try_extract_index_ivf(index) is not None:
+            settings = [(f"nprobe={nprobe}", {"nprobe": nprobe}) for nprobe in nprobes]
+        elif hasattr(index, "hnsw"):
+            settings = [(f"efSearch={ef}", {"ef_search": ef}) for ef in ef_searches]
+        else:
+            settings = [("", {})]
+        for label, params in settings:
+            found, ms = measure(tune_index(index, **params))
+            recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(queries)])
+            results.append({"spec": spec, "param": label, "recall": float(recall), "ms_per_query": ms,
+                            "build_s": build_time, "mb": size})
+    return results
+
+
+def main():
+    # Recall against latency and memory of approximate layouts, or rebuild a saved store with one of them
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index layouts or rebuild the vector store")
+    parser.add_argument("--rebuild", metavar="SPEC", help="rebuild --folder with this index_factory layout")
+    parser.add_argument("--folder", default="vector_store")
+    parser.add_argument("--n", type=int, default=50_000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--specs", nargs="*", default=["HNSW32", "IVF256,Flat", "IVF256,SQ8", "IVF256,PQ48"])
+    parser.add_argument("--output", help="also save the results as JSON")
+    args = parser.parse_args()
+    serve_from_env()
+
+    if args.rebuild:
+        from embedding_cache import get_embeddings
+        rebuild_vector_store(args.folder, get_embeddings(), args.rebuild)
+        return
+
+    results = benchmark(args.n, args.dim, args.queries, args.k, specs=args.specs)
+    print(f"{'index':16s} {'setting':14s} {'recall@' + str(args.k):>9s} {'ms/query':>9s} {'build s':>8s} {'MB':>8s}")
+    for result in results:
+        print(f"{result['spec']:16s} {result['param']:14s} {result['recall']:9.3f} {result['ms_per_query']:9.3f} "
+              f"{result['build_s']:8.2f} {result['mb']:8.1f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()